@@ -0,0 +1,281 @@
+from collections import OrderedDict
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+
+import pyeapi
+
+from connections import json_loads
+from instrumentation import DECODE_DURATION, EAPI_DURATION, POOL_REQUESTS
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def make_ssl_context(verify=False, ca_file=None, ciphers="DEFAULT"):
+    # An explicit context instead of patching the one of the pyeapi
+    # transport. Without verification it behaves like pyeapi.
+    if verify:
+        context = ssl.create_default_context(cafile=ca_file)
+    else:
+        context = ssl._create_unverified_context()
+    context.set_ciphers(ciphers)
+    return context
+
+
+def parse_error(response):
+    # Same as EapiConnection._parse_error_message from pyeapi
+    error = response["error"]
+    command_error = None
+    output = None
+    if "data" in error:
+        command_error = ", ".join(
+            f"{key}: {value!r}" for data in error["data"] for key, value in data.items()
+        )
+        output = error["data"]
+    return error["code"], error["message"], command_error, output
+
+
+class AsyncEapiConnection(object):
+    # One HTTP/1.1 connection to the eAPI of a switch, kept open between
+    # requests unless the switch closes it
+    def __init__(self, host, port, ssl_context, username, password):
+        self._host = host
+        self._port = port
+        self._ssl_context = ssl_context
+        self._auth = ""
+        if username is not None:
+            token = base64.b64encode(f"{username}:{password or ''}".encode())
+            self._auth = f"Authorization: Basic {token.decode()}\r\n"
+        self._reader = None
+        self._writer = None
+
+    def __str__(self):
+        return f"{self._host}:{self._port}"
+
+    async def request(self, body):
+        # Returns the status, the reason and the content of the response
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self._host,
+                self._port,
+                ssl=self._ssl_context,
+                server_hostname=self._host if self._ssl_context else None,
+            )
+        self._writer.write(
+            (
+                "POST /command-api HTTP/1.1\r\n"
+                f"Host: {self._host}\r\n"
+                "Content-Type: application/json-rpc\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"{self._auth}"
+                "\r\n"
+            ).encode("latin-1")
+            + body
+        )
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the switch")
+        version, status, reason = (
+            status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""]
+        )[:3]
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_open = (
+            version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        )
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            content = await self._read_chunked()
+        elif "content-length" in headers:
+            content = await self._reader.readexactly(int(headers["content-length"]))
+        else:
+            content = await self._reader.read()
+            keep_open = False
+        if not keep_open:
+            self.close()
+        return int(status), reason, content
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self._reader.readline()).split(b";")[0], 16)
+            if not size:
+                # skip the trailer
+                while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await self._reader.readexactly(size))
+            await self._reader.readline()
+
+    def is_open(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+
+
+class AsyncEapiClient(object):
+    # Sends the eAPI requests of all scrapes from one event loop thread, so
+    # waiting for the switches does not need a thread per connection. Idle
+    # connections are kept per switch and credentials, like in the
+    # ConnectionPool of the pyeapi transport.
+    def __init__(self, max_size=256, idle_timeout=60):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._ssl_context = None
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        # key -> list of (connection, last used), only used in the loop
+        self._idle = OrderedDict()
+        self._size = 0
+
+    def configure(self, max_size, idle_timeout, ssl_context=None):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._ssl_context = ssl_context
+
+    def get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="eapi", daemon=True
+                ).start()
+        return self._loop
+
+    def execute(self, key, commands, timeout, label=None):
+        # Blocking version of request() for the collector threads
+        future = asyncio.run_coroutine_threadsafe(
+            self.request(key, commands, timeout, label), self.get_loop()
+        )
+        return future.result()
+
+    def _acquire(self, key):
+        protocol, host, port, username, password = key
+        idle = self._idle.get(key)
+        while idle:
+            connection, last_used = idle.pop()
+            self._size -= 1
+            if not idle:
+                del self._idle[key]
+            if time.time() - last_used < self._idle_timeout and connection.is_open():
+                POOL_REQUESTS.labels("hit").inc()
+                return connection, True
+            connection.close()
+        POOL_REQUESTS.labels("miss").inc()
+        ssl_context = None
+        if protocol == "https":
+            ssl_context = self._ssl_context or make_ssl_context()
+        connection = AsyncEapiConnection(
+            host, port or DEFAULT_PORTS[protocol], ssl_context, username, password
+        )
+        return connection, False
+
+    def _release(self, key, connection):
+        if not connection.is_open():
+            return
+        self._idle.setdefault(key, []).append((connection, time.time()))
+        self._idle.move_to_end(key)
+        self._size += 1
+        now = time.time()
+        while self._idle:
+            oldest, idle = next(iter(self._idle.items()))
+            if self._size <= self._max_size and now - idle[0][1] < self._idle_timeout:
+                break
+            idle.pop(0)[0].close()
+            self._size -= 1
+            if not idle:
+                del self._idle[oldest]
+
+    async def request(self, key, commands, timeout, label=None):
+        # Runs the commands on the switch and returns the decoded response.
+        # Raises the same errors as the pyeapi transport. label is the
+        # command label of the request duration.
+        body = json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "method": "runCmds",
+                "params": {"version": 1, "cmds": commands, "format": "json"},
+                "id": str(id(commands)),
+            }
+        ).encode()
+        command = label or (commands[0] if len(commands) == 1 else "batch")
+        connection, reused = self._acquire(key)
+        deadline = time.monotonic() + timeout
+        try:
+            try:
+                start = time.perf_counter()
+                status, reason, content = await asyncio.wait_for(
+                    connection.request(body), timeout
+                )
+            except asyncio.TimeoutError:
+                # also an OSError, but a retry would not be faster
+                raise
+            except (OSError, asyncio.IncompleteReadError):
+                connection.close()
+                if not reused:
+                    raise
+                # the switch has probably closed the idle connection, the
+                # retry only gets the rest of the timeout
+                logging.debug(f"Reconnecting to switch {connection}")
+                connection, reused = self._acquire(key)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                start = time.perf_counter()
+                status, reason, content = await asyncio.wait_for(
+                    connection.request(body), remaining
+                )
+            EAPI_DURATION.labels(command).observe(time.perf_counter() - start)
+            if status == 401:
+                connection.close()
+                raise pyeapi.eapilib.ConnectionError(
+                    str(connection), f"{reason}. {content}", commands
+                )
+            start = time.perf_counter()
+            decoded = json_loads(content)
+            DECODE_DURATION.observe(time.perf_counter() - start)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            connection.close()
+            raise pyeapi.eapilib.ConnectionError(
+                str(connection),
+                f"Socket error during eAPI connection: {str(e) or 'timed out'}",
+                commands,
+            )
+        except ValueError:
+            connection.close()
+            raise pyeapi.eapilib.ConnectionError(
+                str(connection), "unable to connect to eAPI", commands
+            )
+        self._release(key, connection)
+
+        if "error" in decoded:
+            code, message, error, output = parse_error(decoded)
+            raise pyeapi.eapilib.CommandError(
+                code, message, command_error=error, output=output, commands=commands
+            )
+        return decoded
+
+
+CLIENT = AsyncEapiClient()
+# the event loop thread does not survive a fork, start a new one in workers
+os.register_at_fork(after_in_child=CLIENT._reset)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Compares the port pipeline with the previous implementation on a synthetic
+# "show interfaces" payload: JSON decoding and building + rendering metrics.
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from prometheus_client.core import GaugeMetricFamily  # noqa: E402
+
+from collector import AristaMetricsCollector, PORT_STATS_NAMES  # noqa: E402
+from connections import json_loads  # noqa: E402
+from exposition import render  # noqa: E402
+from payloads import show_interfaces  # noqa: E402
+from plan import PlanResolver  # noqa: E402
+
+
+def legacy_collect_port(interfaces):
+    port_stats = {
+        k: GaugeMetricFamily(
+            f"arista_port_{k}",
+            f"Port stats {k}",
+            labels=["device", "description", "mac", "mtu"],
+        )
+        for k in PORT_STATS_NAMES
+    }
+    status = [
+        GaugeMetricFamily(name, name, labels=["device", "description"])
+        for name in ["arista_admin_up", "arista_l2_up", "arista_port_bandwidth"]
+    ]
+    admin_up, l2_up, bandwidth = status
+    for interface in interfaces:
+        iface = interfaces[interface]
+        data = iface["interfaceCounters"]
+        labels = [iface["name"], iface["description"]]
+        admin_up.add_metric(
+            labels=labels, value=0 if iface["interfaceStatus"] == "disabled" else 1
+        )
+        l2_up.add_metric(
+            labels=labels, value=1 if iface["lineProtocolStatus"] == "up" else 0
+        )
+        bandwidth.add_metric(labels=labels, value=int(iface["bandwidth"]))
+        for port_stat in PORT_STATS_NAMES:
+            metric = [
+                interface,
+                iface["description"],
+                iface["physicalAddress"],
+                str(iface["mtu"]),
+            ]
+            port_stats[port_stat].add_metric(metric, float(data[port_stat]))
+    return list(port_stats.values()) + status
+
+
+def lean_collect_port(payload):
+    config = {"username": "", "password": "", "protocol": "https", "timeout": 1}
+    collector = AristaMetricsCollector(config, PlanResolver(config).resolve("bench"))
+    collector._results = {"show interfaces": {"result": [payload]}}
+    return list(collector.collect_port())
+
+
+def best(function, number, repeat):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ports", type=int, default=512)
+    parser.add_argument("--number", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payload = show_interfaces(args.ports)
+    raw = json.dumps({"jsonrpc": "2.0", "id": 1, "result": [payload]}).encode()
+    interfaces = payload["interfaces"]
+
+    results = [
+        ("decode json", best(lambda: json.loads(raw), args.number, args.repeat)),
+        (
+            f"decode {json_loads.__module__}",
+            best(lambda: json_loads(raw), args.number, args.repeat),
+        ),
+        (
+            "legacy build+render",
+            best(
+                lambda: render(legacy_collect_port(interfaces)),
+                args.number,
+                args.repeat,
+            ),
+        ),
+        (
+            "lean build+render",
+            best(lambda: render(lean_collect_port(payload)), args.number, args.repeat),
+        ),
+    ]
+    print(f"{args.ports} interfaces, {len(raw)} bytes of JSON")
+    for name, seconds in results:
+        print(f"{name:24} {seconds * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# End to end benchmark of the exporter. Starts a fake eAPI switch and the
+# exporter, scrapes a number of targets concurrently and reports the scrape
+# latency, the exporter CPU time per scrape, its memory high-water mark and
+# the throughput. The results can be saved as a baseline and later runs
+# compared against it.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import glob
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import yaml
+
+import fake_eapi
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+
+# lower is better for all of them
+COMPARED = ["latency_p50", "latency_p99", "cpu_per_scrape", "memory_hwm_kb"]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+def wait_for_socket(path, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(path):
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on {path}")
+
+
+def start(command, port, path=None):
+    process = subprocess.Popen(
+        command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        if path:
+            wait_for_socket(path)
+        else:
+            wait_for_port(port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def process_tree(pid):
+    # the process and its descendants, the worker processes of the exporter
+    pids = [pid]
+    for task in glob.glob(f"/proc/{pid}/task/*/children"):
+        try:
+            with open(task) as children:
+                for child in children.read().split():
+                    pids.extend(process_tree(int(child)))
+        except FileNotFoundError:
+            pass
+    return pids
+
+
+def cpu_seconds(pid):
+    # CPU time of the process and of its running descendants
+    total = 0
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except FileNotFoundError:
+            continue
+        # utime and stime are the 14th and 15th field of the whole line
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def memory_hwm_kb(pid):
+    # sum of the memory high-water marks of the process and its descendants
+    total = 0
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def scrape(url):
+    start = time.time()
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            size = len(response.read())
+    except OSError:
+        return None, 0
+    return time.time() - start, size
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def exporter_config(args):
+    config = {
+        "listen_port": args.exporter_port,
+        "listen_addr": "127.0.0.1",
+        "username": "bench",
+        "password": "bench",
+        "protocol": "http",
+        "eapi_port": args.fake_port,
+        "disable_certificate_validation": True,
+        "loglevel": "WARNING",
+        "timeout": 20,
+        "server_workers": args.concurrency,
+    }
+    if args.unix_socket:
+        # on-box mode, the exporter reads the local socket without credentials
+        config["protocol"] = "socket"
+        config["eapi_socket"] = args.unix_socket
+        del config["username"], config["password"]
+    for setting in args.set:
+        key, _, value = setting.partition("=")
+        config[key] = yaml.safe_load(value)
+    return config
+
+
+def run(args, exporter):
+    targets = [f"127.0.0.{index + 1}" for index in range(args.targets)]
+    base = f"http://127.0.0.1:{args.exporter_port}/arista?modules={args.modules}"
+    urls = [f"{base}&target={target}" for target in targets]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        # warm up connections and caches
+        list(executor.map(scrape, urls))
+        cpu_start = cpu_seconds(exporter.pid)
+        start = time.time()
+        results = list(executor.map(scrape, urls * args.scrapes))
+        duration = time.time() - start
+        cpu = cpu_seconds(exporter.pid) - cpu_start
+
+    latencies = [latency for latency, _ in results if latency is not None]
+    if not latencies:
+        raise RuntimeError("All scrapes failed")
+    return {
+        "scrapes": len(results),
+        "errors": len(results) - len(latencies),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p90": percentile(latencies, 0.9),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies),
+        "cpu_per_scrape": cpu / len(results),
+        "memory_hwm_kb": memory_hwm_kb(exporter.pid),
+        "throughput": len(latencies) / duration,
+        "bytes_per_scrape": sum(size for _, size in results) / len(results),
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key in COMPARED:
+        if key in baseline and results[key] > baseline[key] * (1 + tolerance):
+            regressions.append(
+                f"{key}: {results[key]:.6g} > {baseline[key]:.6g} (+{tolerance:.0%})"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--targets", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scrapes", type=int, default=5, help="per target")
+    parser.add_argument("--modules", default="all")
+    parser.add_argument("--fake-port", type=int, default=18080)
+    parser.add_argument("--exporter-port", type=int, default=19200)
+    parser.add_argument(
+        "--unix-socket",
+        metavar="PATH",
+        help="serve the fake eAPI on a Unix socket and run the exporter on-box",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="exporter config setting, can be repeated",
+    )
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--baseline", metavar="FILE")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    fake_eapi.add_arguments(parser)
+    args = parser.parse_args()
+
+    fake_command = [
+        sys.executable,
+        os.path.join(BENCHMARKS, "fake_eapi.py"),
+        f"--port={args.fake_port}",
+        f"--ports={args.ports}",
+        f"--bgp-peers={args.bgp_peers}",
+        f"--sfp-lanes={args.sfp_lanes}",
+        f"--latency={args.latency}",
+    ]
+    if args.replay:
+        fake_command.append(f"--replay={args.replay}")
+    if args.unix_socket:
+        fake_command.append(f"--unix-socket={args.unix_socket}")
+        # a socket left over by a killed fake would look like a running one
+        if os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yml") as config:
+        yaml.safe_dump(exporter_config(args), config)
+        config.flush()
+        fake = start(fake_command, args.fake_port, args.unix_socket)
+        try:
+            exporter = start(
+                [sys.executable, "main.py", "-c", config.name], args.exporter_port
+            )
+            try:
+                results = run(args, exporter)
+            finally:
+                exporter.terminate()
+                exporter.wait()
+        finally:
+            fake.terminate()
+            fake.wait()
+
+    print(json.dumps(results, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline:
+            json.dump(results, baseline, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
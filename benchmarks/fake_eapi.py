@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# A stand-in for the eAPI of an Arista switch. It answers JSON-RPC runCmds
+# requests with synthetic or recorded responses, with a configurable latency.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import payloads
+
+# the filtered commands of the exporter, with an interface range or a VRF
+INTERFACE_RANGE_COMMAND = re.compile(r"^show interfaces ([A-Za-z][^ ]*)( .*)?$")
+BGP_VRF_COMMAND = re.compile(r"^show (ip|ipv6) bgp summary vrf ([^ ]+)$")
+# Ethernet1/1-4 -> Ethernet, 1/1-4
+INTERFACE_SPEC = re.compile(r"^([A-Za-z-]*[A-Za-z])(.*)$")
+
+
+def make_handler(responses, latency):
+    class EapiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            request = json.loads(self.rfile.read(length))
+            commands = [
+                command if isinstance(command, str) else command["cmd"]
+                for command in request["params"]["cmds"]
+            ]
+            if latency:
+                time.sleep(latency)
+            self.send_json(run_commands(responses, request["id"], commands))
+
+        def send_json(self, response):
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return EapiHandler
+
+
+def in_range(name, interface_range):
+    # True if the interface is part of an EOS range like Ethernet1-4,
+    # Ethernet1/1-4 or Ethernet1/1,Ethernet2/1. A range segment applies to
+    # all lanes and subinterfaces below it.
+    name_match = INTERFACE_SPEC.match(name.split(".")[0])
+    if not name_match:
+        return False
+    numbers = name_match.group(2).split("/")
+    for spec in interface_range.split(","):
+        spec_match = INTERFACE_SPEC.match(spec)
+        if not spec_match or spec_match.group(1).lower() != name_match.group(1).lower():
+            continue
+        segments = spec_match.group(2).split("/")
+        if len(segments) > len(numbers):
+            continue
+        for segment, number in zip(segments, numbers):
+            first, _, last = segment.partition("-")
+            if not number.isdigit() or not first.isdigit():
+                break
+            last = first if not last else last
+            if int(number) < int(first) or (last != "$" and int(number) > int(last)):
+                break
+        else:
+            return True
+    return False
+
+
+def lookup(responses, command):
+    # Returns the output of a command or None if the fake does not know it
+    if command in responses:
+        return responses[command]
+    match = BGP_VRF_COMMAND.match(command)
+    if match:
+        version, vrf = match.groups()
+        unfiltered = responses.get(
+            "show ip bgp summary vrf all"
+            if version == "ip"
+            else "show ipv6 bgp summary"
+        )
+        if unfiltered is None:
+            return None
+        vrfs = unfiltered["vrfs"]
+        return {"vrfs": {vrf: vrfs[vrf]} if vrf in vrfs else {}}
+    match = INTERFACE_RANGE_COMMAND.match(command)
+    if match:
+        interface_range, rest = match.groups()
+        unfiltered = responses.get("show interfaces" + (rest or ""))
+        if unfiltered is None:
+            return None
+        return {
+            key: {
+                name: data
+                for name, data in interfaces.items()
+                if in_range(name, interface_range)
+            }
+            for key, interfaces in unfiltered.items()
+        }
+    return None
+
+
+def run_commands(responses, request_id, commands):
+    # like eAPI, stop at the first unknown command and return the output of
+    # the commands run so far in the error data
+    result = []
+    for index, command in enumerate(commands):
+        output = lookup(responses, command)
+        if output is None:
+            return {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {
+                    "code": 1002,
+                    "message": (
+                        f"CLI command {index + 1} of {len(commands)} "
+                        f"'{command}' failed: invalid command"
+                    ),
+                    "data": result + [{"errors": ["Invalid input"]}],
+                },
+            }
+        result.append(output)
+    return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+
+def get_responses(args):
+    responses = payloads.responses(args.ports, args.bgp_peers, args.sfp_lanes)
+    if args.replay:
+        # recorded responses, a JSON object of command -> eAPI result
+        with open(args.replay) as replay:
+            responses.update(json.load(replay))
+    return responses
+
+
+def add_arguments(parser):
+    parser.add_argument("--ports", type=int, default=512)
+    parser.add_argument("--bgp-peers", type=int, default=64)
+    parser.add_argument("--sfp-lanes", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0, help="seconds")
+    parser.add_argument("--replay", metavar="FILE", help="recorded responses")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listen", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--unix-socket",
+        metavar="PATH",
+        help="listen on a Unix socket like the local eAPI socket of EOS",
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    handler = make_handler(get_responses(args), args.latency)
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+        httpd = ThreadingUnixStreamServer(args.unix_socket, handler)
+        logging.info(f"Fake eAPI listening on unix:{args.unix_socket}")
+    else:
+        httpd = ThreadingHTTPServer((args.listen, args.port), handler)
+        logging.info(f"Fake eAPI listening on {args.listen}:{args.port}")
+    httpd.daemon_threads = True
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if args.unix_socket:
+            os.unlink(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# Synthetic eAPI responses for the benchmarks
+
+PORT_COUNTERS = [
+    "inBroadcastPkts",
+    "inDiscards",
+    "inMulticastPkts",
+    "inOctets",
+    "inUcastPkts",
+    "outBroadcastPkts",
+    "outDiscards",
+    "outMulticastPkts",
+    "outOctets",
+    "outUcastPkts",
+]
+SFP_SENSORS = ["rxPower", "txBias", "txPower", "voltage"]
+
+
+def interface_names(ports):
+    return [f"Ethernet{port // 4 + 1}/{port % 4 + 1}" for port in range(ports)]
+
+
+def _description(index):
+    return f"uplink to server-{index:04d} port {index % 4}"
+
+
+def show_version():
+    return {
+        "modelName": "DCS-7280CR3-32P4",
+        "serialNumber": "JPE00000000",
+        "version": "4.28.3M",
+        "memTotal": 32827632,
+        "memFree": 23713240,
+    }
+
+
+def show_hardware_capacity():
+    return {
+        "tables": [
+            {
+                "table": table,
+                "chip": f"Jericho{chip}",
+                "feature": feature,
+                "used": 100 * chip,
+                "maxLimit": 65536,
+            }
+            for table in ["LEM", "TCAM", "ECMP"]
+            for feature in ["MAC", "IPv4", "IPv6"]
+            for chip in range(2)
+        ]
+    }
+
+
+def _counters(index):
+    return {
+        counter: index * 1000003 + offset * 7919
+        for offset, counter in enumerate(PORT_COUNTERS)
+    }
+
+
+def show_interfaces(ports=512):
+    interfaces = {}
+    for index, name in enumerate(interface_names(ports)):
+        interfaces[name] = {
+            "name": name,
+            "description": _description(index),
+            "interfaceStatus": "connected" if index % 7 else "disabled",
+            "lineProtocolStatus": "up" if index % 5 else "down",
+            "bandwidth": 25000000000,
+            "physicalAddress": f"00:1c:73:{index >> 16 & 255:02x}:"
+            f"{index >> 8 & 255:02x}:{index & 255:02x}",
+            "mtu": 9214,
+            "interfaceCounters": _counters(index),
+        }
+    return {"interfaces": interfaces}
+
+
+def show_interfaces_counters(ports=512):
+    return {
+        "interfaces": {
+            name: _counters(index) for index, name in enumerate(interface_names(ports))
+        }
+    }
+
+
+def show_interfaces_status(ports=512):
+    return {
+        "interfaceStatuses": {
+            name: {
+                "description": _description(index),
+                "linkStatus": "connected" if index % 5 else "notconnect",
+                "bandwidth": 25000000000,
+            }
+            for index, name in enumerate(interface_names(ports))
+        }
+    }
+
+
+def show_interfaces_transceiver(ports=512, lanes=4, detail=True):
+    # Every fourth interface has a transceiver with the given number of
+    # lanes, the lanes without a configured interface are named /2 to /4.
+    interfaces = {}
+    for index, name in enumerate(interface_names(ports)):
+        if index % 4:
+            continue
+        parent = name.rsplit("/", 1)[0]
+        for lane in range(1, lanes + 1):
+            data = {
+                "mediaType": "100GBASE-SR4",
+                "vendorSn": f"XYZ{index:06d}",
+                "rxPower": -2.5 + lane / 10,
+                "txBias": 6.5,
+                "txPower": -1.0,
+                "voltage": 3.29,
+            }
+            if detail:
+                data["details"] = {
+                    sensor: {
+                        "highAlarm": 10.0,
+                        "highWarn": 9.0,
+                        "lowAlarm": -20.0,
+                        "lowWarn": -19.0,
+                    }
+                    for sensor in SFP_SENSORS
+                }
+            interfaces[f"{parent}/{lane}"] = data
+    return {"interfaces": interfaces}
+
+
+def show_bgp_summary(peers=64, ipv6=False):
+    vrfs = {}
+    for index in range(peers):
+        vrf = f"vrf{index % 4}" if index % 4 else "default"
+        if ipv6:
+            peer = f"2001:db8::{index + 1:x}"
+        else:
+            peer = f"10.{index >> 8 & 255}.{index & 255}.1"
+        vrf_data = vrfs.setdefault(vrf, {"routerId": "192.0.2.1", "peers": {}})
+        vrf_data["peers"][peer] = {
+            "asn": 65000 + index,
+            "peerState": "Established" if index % 9 else "Active",
+            "prefixReceived": index * 10,
+        }
+    return {"vrfs": vrfs}
+
+
+def show_environment_power(supplies=2):
+    return {
+        "powerSupplies": {
+            str(psu): {
+                "state": "ok",
+                "modelName": "PWR-1900AC",
+                "capacity": 1900.0,
+                "inputCurrent": 1.5,
+                "inputVoltage": 230.0,
+                "outputCurrent": 25.0,
+                "outputPower": 300.0,
+                "tempSensors": {
+                    f"TempSensorP{psu}/{sensor}": {"temperature": 30.0, "status": "ok"}
+                    for sensor in range(1, 3)
+                },
+                "fans": {f"FanP{psu}/1": {"speed": 40, "status": "ok"}},
+            }
+            for psu in range(1, supplies + 1)
+        }
+    }
+
+
+def responses(ports=512, bgp_peers=64, sfp_lanes=4):
+    # command -> response of a synthetic switch
+    return {
+        "show version": show_version(),
+        "show hardware capacity": show_hardware_capacity(),
+        "show interfaces": show_interfaces(ports),
+        "show interfaces counters": show_interfaces_counters(ports),
+        "show interfaces status": show_interfaces_status(ports),
+        "show interfaces transceiver": show_interfaces_transceiver(
+            ports, sfp_lanes, detail=False
+        ),
+        "show interfaces transceiver detail": show_interfaces_transceiver(
+            ports, sfp_lanes
+        ),
+        "show ip bgp summary vrf all": show_bgp_summary(bgp_peers),
+        "show ipv6 bgp summary": show_bgp_summary(bgp_peers, ipv6=True),
+        "show environment power": show_environment_power(),
+    }
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Runs several exporter replicas in cluster mode on local ports against the
+# fake eAPI. Every target is scraped through every replica, and the script
+# checks that all scrapes succeed and that each target was collected only
+# by the replica owning it. It also reports how many targets move to
+# another replica when one is added or removed.
+
+import argparse
+import os
+import sys
+import tempfile
+import urllib.request
+
+import yaml
+
+from driver import BENCHMARKS, ROOT, start
+
+sys.path.insert(0, ROOT)
+
+from cluster import HashRing  # noqa: E402
+
+
+def exporter_config(args, port, peers):
+    return {
+        "listen_port": port,
+        "listen_addr": "127.0.0.1",
+        "username": "bench",
+        "password": "bench",
+        "protocol": "http",
+        "eapi_port": args.fake_port,
+        "disable_certificate_validation": True,
+        "loglevel": "WARNING",
+        "timeout": 20,
+        "server_workers": 4,
+        "cluster_peers": peers,
+        "cluster_self": f"http://127.0.0.1:{port}",
+        "cluster_mode": args.mode,
+    }
+
+
+def cluster_requests(port):
+    # result -> number of scrapes from the exporter metrics of a replica
+    counts = {}
+    url = f"http://127.0.0.1:{port}/metrics"
+    with urllib.request.urlopen(url, timeout=10) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith("arista_exporter_cluster_requests_total{"):
+                labels, value = line.rsplit(" ", 1)
+                counts[labels.split('"')[1]] = float(value)
+    return counts
+
+
+def scrape(port, target, modules):
+    url = f"http://127.0.0.1:{port}/arista?target={target}&modules={modules}"
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return "\narista_up 1.0\n" in "\n" + response.read().decode()
+
+
+def moved(nodes, targets, vnodes):
+    # fraction of the targets that change their owner from nodes[:-1] to nodes
+    before = HashRing(nodes[:-1], vnodes)
+    after = HashRing(nodes, vnodes)
+    changed = [t for t in targets if before.owner(t) != after.owner(t)]
+    return len(changed) / len(targets)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--targets", type=int, default=24)
+    parser.add_argument("--modules", default="memory,port")
+    parser.add_argument("--mode", choices=["proxy", "redirect"], default="proxy")
+    parser.add_argument("--vnodes", type=int, default=100)
+    parser.add_argument("--fake-port", type=int, default=18080)
+    parser.add_argument("--exporter-port", type=int, default=19200)
+    args = parser.parse_args()
+
+    ports = [args.exporter_port + index for index in range(args.replicas)]
+    peers = [f"http://127.0.0.1:{port}" for port in ports]
+    targets = [f"127.0.0.{index + 1}" for index in range(args.targets)]
+    ring = HashRing(peers, args.vnodes)
+
+    fake = start(
+        [
+            sys.executable,
+            os.path.join(BENCHMARKS, "fake_eapi.py"),
+            f"--port={args.fake_port}",
+            "--ports=32",
+        ],
+        args.fake_port,
+    )
+    exporters = []
+    failures = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for port in ports:
+                path = os.path.join(directory, f"{port}.yml")
+                with open(path, "w") as config:
+                    yaml.safe_dump(exporter_config(args, port, peers), config)
+                exporters.append(start([sys.executable, "main.py", "-c", path], port))
+            for port in ports:
+                for target in targets:
+                    if not scrape(port, target, args.modules):
+                        failures.append(f"scrape of {target} through {port} failed")
+            for port, peer in zip(ports, peers):
+                owned = sum(1 for target in targets if ring.owner(target) == peer)
+                counts = cluster_requests(port)
+                local = counts.get("local", 0)
+                print(
+                    f"{peer}: owns {owned} targets, served {local:.0f} scrapes, "
+                    f"proxied {counts.get('proxied', 0):.0f}, "
+                    f"redirected {counts.get('redirected', 0):.0f}"
+                )
+                if local != owned * len(ports):
+                    failures.append(
+                        f"{peer} served {local:.0f} scrapes instead of "
+                        f"{owned * len(ports)}"
+                    )
+    finally:
+        for exporter in exporters:
+            exporter.terminate()
+            exporter.wait()
+        fake.terminate()
+        fake.wait()
+
+    names = [f"host{index}" for index in range(10000)]
+    nodes = peers + [f"http://127.0.0.1:{args.exporter_port + args.replicas}"]
+    print(
+        f"targets moved when adding a replica: {moved(nodes, names, args.vnodes):.1%}"
+        f" (ideal {1 / len(nodes):.1%})"
+    )
+    for failure in failures:
+        print(f"FAILED {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
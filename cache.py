@@ -0,0 +1,206 @@
+from collections import OrderedDict
+
+import threading
+import time
+
+
+class SharedStream(object):
+    # Lets several readers iterate over the same chunks while they are being
+    # produced. The reader that reaches the end of the buffer produces the
+    # next chunk, the others wait for it. Readers can only join until the
+    # first chunk is produced, and a chunk is dropped once every reader has
+    # passed it, unless keep is set.
+    def __init__(self, chunks, on_done=None, keep=False):
+        self._chunks = iter(chunks)
+        self._on_done = on_done
+        self._keep = keep
+        self._lock = threading.Condition()
+        self._buffer = []
+        # index of the first chunk in the buffer
+        self._offset = 0
+        # reader -> index of its next chunk
+        self._positions = {}
+        self._started = False
+        self._producing = False
+        self._done = False
+        self._error = None
+
+    def join(self):
+        # Returns an iterator over all chunks, or None when the first chunk
+        # was already produced
+        with self._lock:
+            if self._started:
+                return None
+            reader = object()
+            self._positions[reader] = 0
+        return self._read(reader)
+
+    def _next(self, reader):
+        # Returns the next chunk of the reader from the buffer, None when
+        # the reader has to produce it, or raises StopIteration at the end
+        while True:
+            index = self._positions[reader]
+            if index < self._offset + len(self._buffer):
+                self._positions[reader] = index + 1
+                chunk = self._buffer[index - self._offset]
+                self._trim()
+                return chunk
+            if self._done:
+                if self._error is not None:
+                    raise self._error
+                raise StopIteration
+            if not self._producing:
+                self._producing = True
+                return None
+            self._lock.wait()
+
+    def _read(self, reader):
+        try:
+            while True:
+                with self._lock:
+                    try:
+                        chunk = self._next(reader)
+                    except StopIteration:
+                        return
+                if chunk is None:
+                    # produce the chunk without the lock, so that readers
+                    # can join while the first one is being collected
+                    try:
+                        chunk = next(self._chunks)
+                    except StopIteration:
+                        with self._lock:
+                            self._finish(None)
+                        return
+                    except Exception as e:
+                        with self._lock:
+                            self._finish(e)
+                        raise
+                    with self._lock:
+                        self._started = True
+                        self._producing = False
+                        self._buffer.append(chunk)
+                        self._positions[reader] += 1
+                        self._trim()
+                        self._lock.notify_all()
+                yield chunk
+        finally:
+            with self._lock:
+                del self._positions[reader]
+                if not self._positions and not self._done:
+                    # the last reader went away, stop producing
+                    if hasattr(self._chunks, "close"):
+                        self._chunks.close()
+                    self._finish(RuntimeError("All readers are gone"))
+                self._trim()
+
+    def _trim(self):
+        if self._keep:
+            return
+        passed = min(self._positions.values(), default=self._offset + len(self._buffer))
+        del self._buffer[: passed - self._offset]
+        self._offset = passed
+
+    def _finish(self, error):
+        self._done = True
+        self._producing = False
+        self._error = error
+        self._lock.notify_all()
+        if self._on_done:
+            self._on_done(self, error)
+
+    @property
+    def chunks(self):
+        # all chunks, only while they are kept
+        return list(self._buffer)
+
+
+class SingleFlight(object):
+    # Runs a function only once for concurrent callers with the same key,
+    # the other callers share the chunks it returns. Results can be kept
+    # for a short time to also serve callers that come right after.
+    def __init__(self, ttl=0):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._results = {}
+
+    def stream(self, key, function):
+        # function returns an iterator of chunks, which is shared with the
+        # callers that come before its first chunk. The chunks are only kept
+        # for the later callers when there is a ttl.
+        while True:
+            with self._lock:
+                if key in self._results:
+                    chunks, finished = self._results[key]
+                    if time.time() - finished < self._ttl:
+                        return chunks
+                    del self._results[key]
+                shared = self._streams.get(key)
+                if shared is None:
+                    shared = self._streams[key] = SharedStream(
+                        function(),
+                        on_done=lambda stream, error: self._done(key, stream, error),
+                        keep=bool(self._ttl),
+                    )
+            reader = shared.join()
+            if reader is not None:
+                return reader
+            # the stream is already being sent, start a new one
+            with self._lock:
+                if self._streams.get(key) is shared:
+                    del self._streams[key]
+
+    def _done(self, key, stream, error):
+        # called by the stream with its own lock held
+        with self._lock:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+            if self._ttl and error is None:
+                self._expire()
+                self._results[key] = (stream.chunks, time.time())
+
+    def _expire(self):
+        now = time.time()
+        for key, (_, finished) in list(self._results.items()):
+            if now - finished >= self._ttl:
+                del self._results[key]
+
+
+class TTLCache(object):
+    # Thread safe store of values with their age, bounded to max_size
+    # entries. The maximum age is chosen by the reader.
+    def __init__(self, max_size=4096):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, ttl):
+        entry = self.get_entry(key, ttl)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, key, ttl):
+        # Returns the value and its age in seconds, or None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            age = time.time() - entry[1]
+            if age >= ttl:
+                return None
+            self._data.move_to_end(key)
+            return entry[0], age
+
+    def prune(self, ttl):
+        # Removes the entries that were set more than ttl seconds ago
+        now = time.time()
+        with self._lock:
+            for key, (_, updated) in list(self._data.items()):
+                if now - updated >= ttl:
+                    del self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
@@ -0,0 +1,57 @@
+from bisect import bisect
+from urllib.parse import urlencode
+
+import hashlib
+
+# added to forwarded scrapes, the replica receiving them always serves them
+FORWARDED_PARAM = "forwarded_by"
+
+
+class HashRing(object):
+    # Consistent hash ring of the exporter replicas. Every replica has
+    # vnodes points on the ring and a target belongs to the replica of the
+    # first point after the hash of the target. Adding or removing a
+    # replica only moves the targets next to its points, about 1/n of them.
+    def __init__(self, nodes, vnodes=100):
+        self.nodes = list(dict.fromkeys(nodes))
+        points = sorted(
+            (self._hash(f"{node}#{index}"), node)
+            for node in self.nodes
+            for index in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.md5(key.encode(), usedforsecurity=False).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        index = bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class Cluster(object):
+    # The replicas of the exporter that share the switches. All replicas
+    # need the same cluster_peers so they agree on the owner of a target.
+    def __init__(self, config):
+        self.url = config["cluster_self"].rstrip("/")
+        self.mode = config.get("cluster_mode", "proxy")
+        self.ring = HashRing(
+            [peer.rstrip("/") for peer in config["cluster_peers"]],
+            config.get("cluster_vnodes", 100),
+        )
+
+    def owner(self, target):
+        return self.ring.owner(target)
+
+    def is_local(self, target):
+        return self.owner(target) == self.url
+
+    def forward_url(self, owner, relative_uri):
+        separator = "&" if "?" in relative_uri else "?"
+        query = urlencode({FORWARDED_PARAM: self.url})
+        return f"{owner}{relative_uri}{separator}{query}"
@@ -1,11 +1,18 @@
 from prometheus_client.core import GaugeMetricFamily, InfoMetricFamily
 
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
 import logging
-import os
 import time
 
 import pyeapi
-import ssl
+
+from cache import TTLCache
+from connections import POOL, connect, execute, set_timeout
+from exposition import LabelCache, LeanCounterFamily, LeanGaugeFamily, RenderCache
+from instrumentation import BUILD_DURATION, EAPI_ERRORS
+from interfaces import InterfaceIndex
+from plan import MODULE_DEPENDENCIES, MODULES
 
 PORT_STATS_NAMES = [
     "inBroadcastPkts",
@@ -19,25 +26,83 @@ PORT_STATS_NAMES = [
     "outOctets",
     "outUcastPkts",
 ]
+PORT_STATS_LABELS = ("device", "description", "mac", "mtu")
+PORT_STATUS_LABELS = ("device", "description")
+SFP_STATS_LABELS = ("device", "sensor", "mediaType", "serial", "description", "lane")
+SFP_ALARM_LABELS = ("device", "lane", "sensor", "alarmType")
+
+# slow changing data of the lean port and sfp modes, per target and module
+METADATA_CACHE = TTLCache()
+# metric families of the modules with a module_cache_ttl, together with their
+# rendered output, per target and module
+RESULT_CACHE = TTLCache()
+# interned label sets of the per interface metrics, per target and module
+LABEL_CACHE = TTLCache()
+# previous port counters for the rates, per target
+COUNTER_CACHE = TTLCache()
+# interface index of the last scrape that listed the interfaces, per target
+INTERFACE_CACHE = TTLCache()
+# commands that failed on a switch, per target and command. They are left out
+# of the batches for unsupported_command_ttl seconds.
+UNSUPPORTED_COMMANDS = TTLCache()
+
+
+def up_metric(value):
+    return GaugeMetricFamily(
+        "arista_up",
+        ("Information whether the switch is reachable " "and responds to API calls"),
+        value=value,
+    )
+
+
+def hw_metric(labels):
+    return InfoMetricFamily(
+        "arista_hw",
+        ("Information about this arista device, " "such as serial number and model"),
+        value=labels,
+    )
 
 
 class AristaMetricsCollector(object):
-    def __init__(self, config, target):
-        self._username = os.getenv("ARISTA_USERNAME", config["username"])
-        self._password = os.getenv("ARISTA_PASSWORD", config["password"])
+    # The config holds the settings of the exporter, everything specific
+    # to the scrape comes from the ScrapePlan
+    def __init__(self, config, plan):
+        self._username = plan.username
+        self._password = plan.password
         self._protocol = config["protocol"] or "https"
-        self._timeout = config["timeout"]
-        self._target = target
+        self._port = config.get("eapi_port")
+        self._socket_path = config.get("eapi_socket")
+        self._timeout = plan.timeout
+        self._deadline = plan.deadline
+        self._target = plan.target
+        self._filter = plan.filter
+        # the caches of a target are kept per filter, a filtered scrape
+        # only fetches and builds part of the data
+        self._scope = (self._target, self._filter.key) if self._filter else self._target
         self._labels = {}
         self._switch_up = 0
         self._responsetime = 0
         self._memtotal = 0
         self._memfree = 0
-        self._connection = False
-        self._interfaces = False
-        self._module_names = False
-        if "module_names" in config:
-            self._module_names = config["module_names"]
+        self._keepalive = config.get("connection_keepalive", True)
+        self._eapi_client = config.get("eapi_client", "pyeapi")
+        self._results = {}
+        # whether the switch answered a request of this scrape, also with
+        # an error for a command
+        self._answered = False
+        self._interface_index = None
+        self._modules = plan.modules
+        self._module_concurrency = config.get("module_concurrency", 0)
+        self._port_mode = config.get("port_mode", "full")
+        self._metadata_ttl = config.get("metadata_ttl", 3600)
+        self._port_counters = config.get("port_counters", "gauge")
+        self._port_rates = config.get("port_rates", False)
+        self._port_rate_max_age = config.get("port_rate_max_age", 600)
+        self._module_cache_ttl = config.get("module_cache_ttl") or {}
+        self._unsupported_ttl = config.get("unsupported_command_ttl", 3600)
+        self._cached = {}
+        self._module_timeouts = config.get("module_timeouts") or {}
+        self._module_success = {}
         self._scrape_durations = GaugeMetricFamily(
             "arista_scrape_duration_seconds",
             "Duration of a collector scrape.",
@@ -53,60 +118,221 @@ class AristaMetricsCollector(object):
     def get_connection(self):
         # set the default timeout
         logging.debug(f"Setting timeout to {self._timeout}")
-        if not self._connection:
-            logging.info(f"Connecting to switch {self._target}")
-            self._connection = pyeapi.connect(
-                transport=self._protocol,
-                host=self._target,
-                username=self._username,
-                password=self._password,
-                timeout=self._timeout,
+        logging.info(f"Connecting to switch {self._target}")
+        return connect(
+            self._protocol,
+            self._target,
+            self._username,
+            self._password,
+            self._timeout,
+            keepalive=self._keepalive,
+            port=self._port,
+            path=self._socket_path,
+        )
+
+    def get_timeout(self, deadline=None):
+        # the deadline of a module can only shorten the one of the scrape
+        if self._deadline:
+            deadline = min(deadline or self._deadline, self._deadline)
+        if not deadline:
+            return self._timeout
+        timeout = min(self._timeout, deadline - time.time())
+        if timeout <= 0:
+            raise pyeapi.eapilib.ConnectionError(
+                self._target, "Scrape deadline exceeded"
             )
-            # workaround to allow sslv3 ciphers for python =>3.10
-            self._connection.transport._context.set_ciphers('DEFAULT')
-        return self._connection
+        return timeout
 
-    def switch_command(self, command):
-        switch_result = ""
+    def execute(self, commands, deadline=None):
+        # Connections are taken from the process wide pool, so that the TLS
+        # session and the SSL context are reused across scrapes. Connections
+        # are not thread safe, each concurrent module worker gets its own.
+        key = (
+            self._protocol,
+            self._target,
+            self._port,
+            self._username,
+            self._password,
+        )
+        timeout = self.get_timeout(deadline)
+        # the filters of a request must not create new label values
+        label = "batch"
+        if len(commands) == 1:
+            label = self._filter.base_command(commands[0])
+        if self._eapi_client == "async":
+            # only loaded when used, it is not needed on the switch
+            from async_eapi import CLIENT
+
+            return CLIENT.execute(key, commands, timeout, label)
+        connection, reused = POOL.acquire(key, self.get_connection)
+        set_timeout(connection, timeout)
+        try:
+            result = execute(connection, commands, label)
+        except pyeapi.eapilib.ConnectionError:
+            POOL.discard(connection)
+            if not reused:
+                raise
+            # the switch has probably closed the idle connection, rebuild it
+            logging.debug(f"Reconnecting to switch {self._target}")
+            connection = self.get_connection()
+            set_timeout(connection, self.get_timeout(deadline))
+            try:
+                result = execute(connection, commands, label)
+            except pyeapi.eapilib.ConnectionError:
+                POOL.discard(connection)
+                raise
+            except pyeapi.eapilib.CommandError:
+                POOL.release(key, connection)
+                raise
+        except pyeapi.eapilib.CommandError:
+            POOL.release(key, connection)
+            raise
+        POOL.release(key, connection)
+        return result
+
+    def switch_commands(self, commands, deadline=None):
+        # Send all commands of the scrape as one runCmds request. eAPI stops
+        # at the first failing command and returns the output of the ones
+        # before it, the commands after it are sent again without it.
+        # Commands that failed on the switch are not sent for a while.
+        commands = [c for c in commands if not self._is_unsupported(c)]
+        while commands:
+            try:
+                logging.debug(f"Running commands {commands}")
+                switch_result = self.execute(commands, deadline)
+            except pyeapi.eapilib.ConnectionError as pyeapi_connect_except:
+                EAPI_ERRORS.labels("connection").inc()
+                logging.error(
+                    ("PYEAPI Client Connection Exception: " f"{pyeapi_connect_except}")
+                )
+                for command in commands:
+                    self._results[command] = ""
+                return
+            except pyeapi.eapilib.CommandError as pyeapi_command_except:
+                EAPI_ERRORS.labels("command").inc()
+                self._answered = True
+                output = pyeapi_command_except.output or []
+                failed = len(output) - 1
+                if failed < 0 or failed >= len(commands) or "errors" not in output[-1]:
+                    # the error does not name a command, run them one by one
+                    logging.warning(
+                        "Batched commands failed, falling back to single commands: "
+                        f"{pyeapi_command_except.error_text}"
+                    )
+                    for command in commands:
+                        self._results[command] = self.switch_command(command, deadline)
+                    return
+                for command, result in zip(commands, output[:failed]):
+                    self._results[command] = {"result": [result]}
+                self._set_unsupported(commands[failed], output[-1]["errors"])
+                commands = commands[failed + 1 :]
+            else:
+                self._answered = True
+                for command, result in zip(commands, switch_result["result"]):
+                    self._results[command] = {"result": [result]}
+                return
 
-        connection = self.get_connection()
+    def _is_unsupported(self, command):
+        if not self._unsupported_ttl or not UNSUPPORTED_COMMANDS.get(
+            (self._target, command), self._unsupported_ttl
+        ):
+            return False
+        self._results[command] = ""
+        return True
+
+    def _set_unsupported(self, command, errors):
+        logging.warning(
+            f"Command {command} failed on switch {self._target}: "
+            f"{'; '.join(map(str, errors))}"
+        )
+        self._results[command] = ""
+        if self._unsupported_ttl:
+            UNSUPPORTED_COMMANDS.set((self._target, command), True)
+
+    def switch_command(self, command, deadline=None):
+        if command in self._results:
+            return self._results[command]
+
+        switch_result = ""
 
         try:
             logging.debug(f"Running command {command}")
-            switch_result = connection.execute([command])
+            switch_result = self.execute([command], deadline)
+            self._answered = True
         except pyeapi.eapilib.ConnectionError as pyeapi_connect_except:
-            self._connection = False
+            EAPI_ERRORS.labels("connection").inc()
             logging.error(
                 ("PYEAPI Client Connection Exception: " f"{pyeapi_connect_except}")
             )
         except pyeapi.eapilib.CommandError as pyeapi_command_except:
-            self._connection = False
+            EAPI_ERRORS.labels("command").inc()
+            self._answered = True
             logging.error(
                 ("PYEAPI Client Command Exception: " f"{pyeapi_command_except}")
             )
         finally:
             return switch_result
 
+    def _get_cached_modules(self):
+        # Returns name -> (metrics, age) of the modules with a fresh result
+        # in the cache. Modules needed by another requested module always run.
+        cached = {}
+        if not self._module_cache_ttl:
+            return cached
+        modules = self.get_modules()
+        dependencies = self.get_module_dependencies()
+        needed = {dep for name in modules for dep in dependencies.get(name, [])}
+        for name in ["base"] + list(modules):
+            ttl = self._module_cache_ttl.get(name)
+            if not ttl or name in needed:
+                continue
+            entry = RESULT_CACHE.get_entry((self._scope, name), ttl)
+            if entry is not None:
+                cached[name] = entry
+        return cached
+
+    def _cache_module(self, name, metrics):
+        if self._module_cache_ttl.get(name) and metrics:
+            RESULT_CACHE.set((self._scope, name), metrics)
+
     def _get_labels(self):
         start = time.time()
-        # Get the switch info for the labels
-        switch_info = self.switch_command("show version")
-        try:
-            si_res = switch_info["result"][0]
-        except Exception as e:
-            logging.debug(f"No result from switch {self._target}: {e}")
-            labels_switch = {"model": "unknown", "serial": "unknown"}
-            self._switch_up = 0
+        # Fetch the data of all requested modules in one round trip
+        commands = [c for c in self.get_commands() if not self._is_unsupported(c)]
+        if "base" in self._cached and not commands:
+            # everything requested is cached or not supported by the switch,
+            # ask the switch anyway so that an outage is not hidden. The
+            # answer is not used.
+            commands = ["show version"]
+        if commands:
+            self.switch_commands(commands)
+        if "base" in self._cached:
+            # the switch info is cached, the switch is only considered down
+            # when it did not answer the request
+            (labels_switch, self._memtotal, self._memfree), _ = self._cached["base"]
+            self._switch_up = 1 if self._answered else 0
         else:
-            logging.debug(f"Received a result from switch {self._target}")
-            labels_switch = {
-                "model": si_res["modelName"],
-                "serial": si_res["serialNumber"],
-                "version": si_res["version"],
-            }
-            self._memtotal = si_res["memTotal"]
-            self._memfree = si_res["memFree"]
-            self._switch_up = 1
+            # Get the switch info for the labels
+            switch_info = self.switch_command("show version")
+            try:
+                si_res = switch_info["result"][0]
+            except Exception as e:
+                logging.debug(f"No result from switch {self._target}: {e}")
+                labels_switch = {"model": "unknown", "serial": "unknown"}
+                self._switch_up = 0
+            else:
+                logging.debug(f"Received a result from switch {self._target}")
+                labels_switch = {
+                    "model": si_res["modelName"],
+                    "serial": si_res["serialNumber"],
+                    "version": si_res["version"],
+                }
+                self._memtotal = si_res["memTotal"]
+                self._memfree = si_res["memFree"]
+                self._switch_up = 1
+                self._cache_module(
+                    "base", (labels_switch, self._memtotal, self._memfree)
+                )
 
         end = time.time()
         self._responsetime = end - start
@@ -156,172 +382,362 @@ class AristaMetricsCollector(object):
             yield total_metrics
             yield used_metrics
 
+    def get_interface_index(self):
+        # Built from the interface list of this scrape if there is one,
+        # otherwise the one of a previous scrape is used
+        if self._interface_index is None:
+            interfaces = None
+            for command, key in [
+                ("show interfaces", "interfaces"),
+                ("show interfaces status", "interfaceStatuses"),
+            ]:
+                command = self._filter.interface_command(command)
+                if self._results.get(command):
+                    interfaces = self._results[command]["result"][0][key]
+                    break
+            if interfaces is not None:
+                index = InterfaceIndex(
+                    {
+                        name: iface.get("description", "")
+                        for name, iface in interfaces.items()
+                    }
+                )
+                INTERFACE_CACHE.set(self._scope, index)
+            else:
+                index = INTERFACE_CACHE.get(self._scope, self._metadata_ttl)
+            self._interface_index = index or InterfaceIndex({})
+        return self._interface_index
+
+    def _get_port_data(self):
+        # Returns an iterator of (interface, name, description, mac, mtu,
+        # admin up, l2 up, bandwidth, counters) for every interface with
+        # counters, or None without data
+        port_interfaces = self.switch_command(
+            self._filter.interface_command("show interfaces")
+        )
+        if not port_interfaces:
+            return None
+        return self._iter_port_data(port_interfaces["result"][0]["interfaces"])
+
+    def _iter_port_data(self, interfaces):
+        for interface, iface in interfaces.items():
+            member = iface.get("interfaceMembership", "").startswith("Member of")
+            if not self._filter.interface(interface, member):
+                continue
+            try:
+                data = iface["interfaceCounters"]
+            except KeyError:
+                logging.debug(
+                    (
+                        f"Interface {interface} on {self._target}"
+                        " does not have interfaceCounters,"
+                        " skipping"
+                    )
+                )
+                continue
+            yield (
+                interface,
+                iface["name"],
+                iface["description"],
+                iface["physicalAddress"],
+                str(iface["mtu"]),
+                0 if iface["interfaceStatus"] == "disabled" else 1,
+                1 if iface["lineProtocolStatus"] == "up" else 0,
+                int(iface["bandwidth"]),
+                data,
+            )
+
+    def _get_lean_port_data(self):
+        # Counters and status come from the small "show interfaces counters"
+        # and "show interfaces status" outputs. MAC and MTU rarely change,
+        # they are taken from "show interfaces" and cached for metadata_ttl.
+        command = self._filter.interface_command
+        port_counters = self.switch_command(command("show interfaces counters"))
+        port_status = self.switch_command(command("show interfaces status"))
+        if not port_counters or not port_status:
+            return None
+        return self._iter_lean_port_data(
+            port_counters["result"][0]["interfaces"],
+            port_status["result"][0]["interfaceStatuses"],
+            self._get_metadata("port", command("show interfaces"), self._port_metadata),
+        )
+
+    def _iter_lean_port_data(self, counters, statuses, metadata):
+        for interface, data in counters.items():
+            try:
+                status = statuses[interface]
+            except KeyError:
+                logging.debug(
+                    f"Interface {interface} on {self._target} has no status, skipping"
+                )
+                continue
+            # members of a Port-Channel forward at the data link layer
+            vlan = status.get("vlanInformation", {})
+            member = vlan.get("interfaceForwardingModel") == "dataLink"
+            if not self._filter.interface(interface, member):
+                continue
+            mac, mtu = metadata.get(interface, ("", ""))
+            yield (
+                interface,
+                interface,
+                status["description"],
+                mac,
+                mtu,
+                0 if status["linkStatus"] == "disabled" else 1,
+                1 if status["linkStatus"] == "connected" else 0,
+                int(status["bandwidth"]),
+                data,
+            )
+
+    def _port_metadata(self, result):
+        return {
+            interface: (iface["physicalAddress"], str(iface["mtu"]))
+            for interface, iface in result["interfaces"].items()
+            if "physicalAddress" in iface
+        }
+
+    def _get_metadata(self, module, command, extract):
+        # Returns the cached metadata of the module, refreshed from the
+        # command output when the command was part of this scrape
+        key = (self._scope, module)
+        data = self.switch_command(command) if command in self._results else None
+        if data:
+            metadata = extract(data["result"][0])
+            METADATA_CACHE.set(key, metadata)
+            return metadata
+        return METADATA_CACHE.get(key, self._metadata_ttl) or {}
+
+    def _get_label_cache(self, module):
+        key = (self._scope, module)
+        label_cache = LABEL_CACHE.get(key, float("inf"))
+        if label_cache is None:
+            label_cache = LabelCache()
+            LABEL_CACHE.set(key, label_cache)
+        label_cache.rotate()
+        return label_cache
+
+    def _get_previous_counters(self, now):
+        # Returns the counters of the previous scrape and its age
+        entry = COUNTER_CACHE.get(self._scope, self._port_rate_max_age)
+        if entry is None:
+            return {}, 0
+        previous, counters = entry
+        return counters, now - previous
+
+    def _store_counters(self, now, counters):
+        # forget the targets that are no longer scraped
+        COUNTER_CACHE.prune(self._port_rate_max_age)
+        COUNTER_CACHE.set(self._scope, (now, counters))
+
+    def _add_rates(self, port_rates, labels, previous, current, elapsed):
+        # previous is None for new interfaces, for example after a breakout
+        # change, there is no rate until their second scrape
+        if previous is None or elapsed <= 0:
+            return
+        for port_stat, old, new in zip(PORT_STATS_NAMES, previous, current):
+            if old is None or new is None:
+                continue
+            delta = new - old
+            if delta < 0:
+                # the counter was reset, count from zero like rate() does
+                delta = new
+            port_rates[port_stat].add(labels, delta / elapsed)
+
     def collect_port(self):
-        port_interfaces = self.switch_command("show interfaces")
+        if self._port_counters == "counter":
+            stats_family = LeanCounterFamily
+        else:
+            stats_family = LeanGaugeFamily
         port_stats = {
-            k: GaugeMetricFamily(
-                f"arista_port_{k}",
-                f"Port stats {k}",
-                labels=["device", "description", "mac", "mtu"],
+            k: stats_family(
+                f"arista_port_{k}", f"Port stats {k}", labels=PORT_STATS_LABELS
             )
             for k in PORT_STATS_NAMES
         }
-        port_admin_up = GaugeMetricFamily(
+        port_rates = None
+        if self._port_rates:
+            now = time.time()
+            port_rates = {
+                k: LeanGaugeFamily(
+                    f"arista_port_{k}_rate",
+                    f"Port stats {k} per second since the previous scrape",
+                    labels=PORT_STATS_LABELS,
+                )
+                for k in PORT_STATS_NAMES
+            }
+            previous, elapsed = self._get_previous_counters(now)
+            counters = {}
+        port_admin_up = LeanGaugeFamily(
             "arista_admin_up",
             "Value 1 if port is not shutdown",
-            labels=["device", "description"],
+            labels=PORT_STATUS_LABELS,
         )
-        port_l2_up = GaugeMetricFamily(
+        port_l2_up = LeanGaugeFamily(
             "arista_l2_up",
             "Value 1 if port is connected",
-            labels=["device", "description"],
+            labels=PORT_STATUS_LABELS,
         )
-        port_bandwidth = GaugeMetricFamily(
+        port_bandwidth = LeanGaugeFamily(
             "arista_port_bandwidth",
             "Bandwidth in bits/s",
-            labels=["device", "description"],
+            labels=PORT_STATUS_LABELS,
         )
 
-        if port_interfaces:
-            self._interfaces = port_interfaces["result"][0]["interfaces"]
-            for interface in self._interfaces:
-                try:
-                    iface = self._interfaces[interface]
-                    data = iface["interfaceCounters"]
-                except KeyError:
-                    logging.debug(
-                        (
-                            f"Interface {interface} on {self._target}"
-                            " does not have interfaceCounters,"
-                            " skipping"
-                        )
-                    )
-                    continue
-                if iface["interfaceStatus"] == "disabled":
-                    port_admin_up.add_metric(
-                        labels=[iface["name"], iface["description"]], value=0
-                    )
-                else:
-                    port_admin_up.add_metric(
-                        labels=[iface["name"], iface["description"]], value=1
-                    )
-                if iface["lineProtocolStatus"] == "up":
-                    port_l2_up.add_metric(
-                        labels=[iface["name"], iface["description"]], value=1
-                    )
-                else:
-                    port_l2_up.add_metric(
-                        labels=[iface["name"], iface["description"]], value=0
-                    )
-                port_bandwidth.add_metric(
-                    labels=[iface["name"], iface["description"]],
-                    value=int(iface["bandwidth"]),
+        if self._port_mode == "lean":
+            ports = self._get_lean_port_data()
+        else:
+            ports = self._get_port_data()
+        if ports is None:
+            return
+        # share the interface list of this scrape with the other modules
+        self.get_interface_index()
+        label_cache = self._get_label_cache("port")
+        for interface, name, description, mac, mtu, admin, l2, bw, data in ports:
+            # the label sets are formatted once, shared by all families and
+            # reused by the next scrapes while the interface does not change
+            stats_labels = label_cache.get(
+                PORT_STATS_LABELS, (interface, description, mac, mtu)
+            )
+            status_labels = label_cache.get(PORT_STATUS_LABELS, (name, description))
+            port_admin_up.add(status_labels, admin)
+            port_l2_up.add(status_labels, l2)
+            port_bandwidth.add(status_labels, bw)
+            for port_stat in PORT_STATS_NAMES:
+                if port_stat in data:
+                    port_stats[port_stat].add(stats_labels, float(data[port_stat]))
+            if port_rates is not None:
+                current = tuple(data.get(port_stat) for port_stat in PORT_STATS_NAMES)
+                counters[interface] = current
+                self._add_rates(
+                    port_rates,
+                    stats_labels,
+                    previous.get(interface),
+                    current,
+                    elapsed,
                 )
-                for port_stat in PORT_STATS_NAMES:
-                    metric = [
-                        interface,
-                        iface["description"],
-                        iface["physicalAddress"],
-                        str(iface["mtu"]),
-                    ]
-                    port_stats[port_stat].add_metric(metric, float(data[port_stat]))
-            yield from port_stats.values()
-            yield port_admin_up
-            yield port_l2_up
-            yield port_bandwidth
+        yield from port_stats.values()
+        yield port_admin_up
+        yield port_l2_up
+        yield port_bandwidth
+        if port_rates is not None:
+            self._store_counters(now, counters)
+            yield from port_rates.values()
+
+    def _get_transceivers(self):
+        command = self._filter.interface_command
+        if self._port_mode != "lean":
+            sfp = self.switch_command(command("show interfaces transceiver detail"))
+            return sfp["result"][0]["interfaces"] if sfp else None
+        # the alarm thresholds rarely change, they are taken from the detail
+        # output and cached for metadata_ttl
+        sfp = self.switch_command(command("show interfaces transceiver"))
+        if not sfp:
+            return None
+        thresholds = self._get_metadata(
+            "sfp", command("show interfaces transceiver detail"), self._sfp_thresholds
+        )
+        return {
+            iface: dict(data, details=thresholds.get(iface, {})) if data else data
+            for iface, data in sfp["result"][0]["interfaces"].items()
+        }
+
+    def _sfp_thresholds(self, result):
+        return {
+            iface: data["details"]
+            for iface, data in result["interfaces"].items()
+            if data and "details" in data
+        }
 
     def collect_sfp(self):
-        sfp = self.switch_command("show interfaces transceiver detail")
+        sfps = self._get_transceivers()
         sensor_entries = ["rxPower", "txBias", "txPower", "voltage"]
 
-        if sfp:
-            sfp_labels = [
-                "device",
-                "sensor",
-                "mediaType",
-                "serial",
-                "description",
-                "lane",
-            ]
-            sfp_stats_metrics = GaugeMetricFamily(
-                "arista_sfp_stats", "SFP Statistics", labels=sfp_labels
+        if sfps is not None:
+            sfp_stats_metrics = LeanGaugeFamily(
+                "arista_sfp_stats", "SFP Statistics", labels=SFP_STATS_LABELS
             )
-            alarm_labels = ["device", "lane", "sensor", "alarmType"]
-            sfp_alarms = GaugeMetricFamily(
-                "arista_sfp_alarms", "SFP Alarms", labels=alarm_labels
+            sfp_alarms = LeanGaugeFamily(
+                "arista_sfp_alarms", "SFP Alarms", labels=SFP_ALARM_LABELS
             )
-            for iface, data in sfp["result"][0]["interfaces"].items():
-                interface = iface
+            label_cache = self._get_label_cache("sfp")
+            index = self.get_interface_index()
+            serials = {
+                iface: data.get("vendorSn") for iface, data in sfps.items() if data
+            }
+            for iface, data in sfps.items():
                 lane = iface
                 if not data:
-                    logging.debug(f"Port does not have SFP: {interface}")
+                    logging.debug(f"Port does not have SFP: {iface}")
                     continue
-                description = ""
                 # Lane detection. Lane is an optical transmitter that is
                 # a part of an interface. For example, 100G interface
                 # is usually comprised of four 25G lanes or ten 10G lanes.
-                if iface not in self._interfaces:
-                    logging.debug(
+                interface = index.resolve(iface, serials)
+                if not self._filter.interface(interface):
+                    continue
+                if interface != iface:
+                    logging.debug(f"Setting lane {lane} as part of {interface}")
+                description = index.description(interface)
+                for sensor in sensor_entries:
+                    labels = label_cache.get(
+                        SFP_STATS_LABELS,
                         (
-                            f"Port {interface} not found in interfaces"
-                            ". Looking for a lane"
-                        )
+                            interface,
+                            sensor,
+                            data["mediaType"],
+                            data["vendorSn"],
+                            description,
+                            lane,
+                        ),
                     )
-                    try_iface = "/".join(interface.split("/")[0:-1]) + "/1"
-                    sfps = sfp["result"][0]["interfaces"]
-                    if sfps[iface]["vendorSn"] == sfps[try_iface]["vendorSn"]:
-                        lane = iface
-                        interface = try_iface
-                        logging.debug(
-                            (f"Setting lane {lane} as " "part of {interface}")
-                        )
-                try:
-                    description = self._interfaces[interface]["description"]
-                except KeyError:
-                    pass
-                for sensor in sensor_entries:
-                    labels = [
-                        interface,
-                        sensor,
-                        data["mediaType"],
-                        data["vendorSn"],
-                        description,
-                        lane,
-                    ]
                     logging.debug(
                         (
                             f"Adding: interface={interface} "
                             f"sensor={sensor} value={data[sensor]} "
-                            f"labels={labels}"
+                            f"labels={labels.values}"
                         )
                     )
-                    sfp_stats_metrics.add_metric(
-                        value=float(data[sensor]), labels=labels
-                    )
+                    sfp_stats_metrics.add(labels, float(data[sensor]))
                     # check thresholds and generate alerts
+                    if sensor not in data["details"]:
+                        continue
                     thresholds = data["details"][sensor]
-                    labels = [interface, lane, sensor]
                     if data[sensor] > thresholds["highAlarm"]:
-                        labels.append("highAlarm")
-                        sfp_alarms.add_metric(labels=labels, value=data[sensor])
+                        alarm = "highAlarm"
                     elif data[sensor] > thresholds["highWarn"]:
-                        labels.append("highWarn")
-                        sfp_alarms.add_metric(labels=labels, value=data[sensor])
+                        alarm = "highWarn"
                     elif data[sensor] < thresholds["lowAlarm"]:
-                        labels.append("lowAlarm")
-                        sfp_alarms.add_metric(labels=labels, value=data[sensor])
+                        alarm = "lowAlarm"
                     elif data[sensor] < thresholds["lowWarn"]:
-                        labels.append("lowWarn")
-                        sfp_alarms.add_metric(labels=labels, value=data[sensor])
+                        alarm = "lowWarn"
+                    else:
+                        continue
+                    labels = label_cache.get(
+                        SFP_ALARM_LABELS, (interface, lane, sensor, alarm)
+                    )
+                    sfp_alarms.add(labels, data[sensor])
 
             yield sfp_stats_metrics
             yield sfp_alarms
 
+    def _get_bgp_vrfs(self, commands):
+        # Returns the VRFs of all commands, or None without any data
+        vrfs = None
+        for command in commands:
+            data = self.switch_command(command)
+            if data:
+                vrfs = vrfs or {}
+                vrfs.update(data["result"][0]["vrfs"])
+        return vrfs
+
     def collect_bgp(self):
-        data = self.switch_command("show ip bgp summary vrf all")
-        ipv4 = data["result"][0]["vrfs"]
-        data = self.switch_command("show ipv6 bgp summary")
-        ipv6 = data["result"][0]["vrfs"]
+        ipv4_commands, ipv6_commands = self._filter.bgp_commands()
+        ipv4 = self._get_bgp_vrfs(ipv4_commands)
+        ipv6 = self._get_bgp_vrfs(ipv6_commands)
+        if ipv4 is None and ipv6 is None:
+            return
+        ipv4 = ipv4 or {}
+        ipv6 = ipv6 or {}
 
         labels = ["vrf", "peer", "asn"]
         prefixes = GaugeMetricFamily(
@@ -334,10 +750,12 @@ class AristaMetricsCollector(object):
         )
 
         for vrf, vrf_data in ipv4.items():
-            if "peers" not in vrf_data:
+            if "peers" not in vrf_data or not self._filter.vrf(vrf):
                 continue
             router_id = vrf_data["routerId"]
             for peer, peer_data in vrf_data["peers"].items():
+                if not self._filter.peer_state(peer_data["peerState"]):
+                    continue
                 labels = {
                     "vrf": vrf,
                     "router_id": router_id,
@@ -349,10 +767,12 @@ class AristaMetricsCollector(object):
                 labels = [vrf, peer, str(peer_data["asn"])]
                 prefixes.add_metric(value=peer_data["prefixReceived"], labels=labels)
         for vrf, vrf_data in ipv6.items():
-            if "peers" not in vrf_data:
+            if "peers" not in vrf_data or not self._filter.vrf(vrf):
                 continue
             router_id = vrf_data["routerId"]
             for peer, peer_data in vrf_data["peers"].items():
+                if not self._filter.peer_state(peer_data["peerState"]):
+                    continue
                 labels = {
                     "vrf": vrf,
                     "router_id": router_id,
@@ -367,6 +787,10 @@ class AristaMetricsCollector(object):
         yield prefixes
 
     def collect_power(self):
+        data = self.switch_command("show environment power")
+        if not data:
+            return
+
         psu_info = InfoMetricFamily(
             "arista_power_supply",
             "State of the power supply",
@@ -389,7 +813,6 @@ class AristaMetricsCollector(object):
         )
 
         measurements = ["inputCurrent", "inputVoltage", "outputCurrent", "outputPower"]
-        data = self.switch_command("show environment power")
         for psu_id, psu in data["result"][0]["powerSupplies"].items():
             labels = {
                 "state": psu["state"],
@@ -418,58 +841,192 @@ class AristaMetricsCollector(object):
         yield psu_fan
 
     def get_all_modules(self):
+        return {name: getattr(self, f"collect_{name}") for name in MODULES}
+
+    def get_all_commands(self):
+        port = ["show interfaces"]
+        sfp = ["show interfaces transceiver detail"]
+        if self._port_mode == "lean":
+            port = ["show interfaces counters", "show interfaces status"]
+            if METADATA_CACHE.get((self._scope, "port"), self._metadata_ttl) is None:
+                port.append("show interfaces")
+            sfp = ["show interfaces transceiver"]
+            if METADATA_CACHE.get((self._scope, "sfp"), self._metadata_ttl) is None:
+                sfp.append("show interfaces transceiver detail")
+        if INTERFACE_CACHE.get(self._scope, self._metadata_ttl) is None:
+            # the lane detection of sfp needs the interfaces of the switch
+            sfp.append("show interfaces status")
+        ipv4, ipv6 = self._filter.bgp_commands()
         return {
-            "memory": self.collect_memory,
-            "tcam": self.collect_tcam,
-            "port": self.collect_port,
-            "sfp": self.collect_sfp,
-            "bgp": self.collect_bgp,
-            "power": self.collect_power,
+            "memory": [],
+            "tcam": ["show hardware capacity"],
+            "port": [self._filter.interface_command(command) for command in port],
+            "sfp": [self._filter.interface_command(command) for command in sfp],
+            "bgp": ipv4 + ipv6,
+            "power": ["show environment power"],
         }
 
+    def get_commands(self):
+        all_commands = self.get_all_commands()
+        commands = [] if "base" in self._cached else ["show version"]
+        if self._module_concurrency:
+            # every module fetches its own data in its worker
+            return commands
+        for name in self.get_modules():
+            if name in self._cached or name in self._module_timeouts:
+                # modules with their own timeout fetch their data separately
+                continue
+            for command in all_commands[name]:
+                if command not in commands:
+                    commands.append(command)
+        return commands
+
     def get_modules(self):
+        # the modules of the plan, already in the order to run them
         all_modules = self.get_all_modules()
-        if not self._module_names:
-            return all_modules
-        module_functions = {}
-        modules = self._module_names.split(",")
-        for module in modules:
-            if module == "all":
-                return all_modules
-            elif module in all_modules:
-                module_functions[module] = all_modules[module]
-            else:
-                logging.warning(f"Unknown module requested:{module}. Ignoring")
-        return module_functions
+        return {name: all_modules[name] for name in self._modules}
 
-    def collect(self):
-        self._get_labels()
-        self._interfaces = False
-        # Export the up and response metrics
-        yield GaugeMetricFamily(
-            "arista_up",
-            (
-                "Information whether the switch is reachable "
-                "and responds to API calls"
-            ),
-            value=self._switch_up,
-        )
+    def get_module_dependencies(self):
+        return MODULE_DEPENDENCIES
 
-        if self._switch_up == 1:
+    def _module_metrics(self, name, generator):
+        # Returns the metrics of the module and whether it succeeded. The
+        # metrics built before a failure are kept.
+        if name in self._cached:
+            return self._cached[name][0], True
+        metrics = []
+        try:
+            with BUILD_DURATION.labels(name).time():
+                for metric in generator():
+                    metrics.append(metric)
+        except Exception as e:
+            logging.error(f"Collector {name} failed on {self._target}: {e}")
+            return metrics, False
+        if self._module_cache_ttl.get(name) and metrics:
+            # rendered once per format, also by the scrapes served from cache
+            metrics = [RenderCache(metrics)]
+        self._cache_module(name, metrics)
+        return metrics, True
 
-            yield InfoMetricFamily(
-                "arista_hw",
-                (
-                    "Information about this arista device, "
-                    "such as serial number and model"
-                ),
-                value=self._labels,
-            )
+    def _run_module(self, name, generator):
+        # Fetches the data of the module that is not part of the batched
+        # request, within the timeout of the module, and builds its metrics
+        start = time.time()
+        deadline = None
+        if name in self._module_timeouts:
+            deadline = start + self._module_timeouts[name]
+        commands = self.get_all_commands()[name]
+        if name not in self._cached:
+            missing = [command for command in commands if command not in self._results]
+            if missing:
+                self.switch_commands(missing, deadline)
+        metrics, success = self._module_metrics(name, generator)
+        if name not in self._cached:
+            success = success and all(self._results.get(c) for c in commands)
+        # a module abandoned by the scrape stays failed
+        self._module_success.setdefault(name, 1 if success else 0)
+        return metrics, time.time() - start
 
-            for name, generator in self.get_modules().items():
+    def _remaining(self):
+        if not self._deadline:
+            return None
+        return max(self._deadline - time.time(), 0)
+
+    def _collect_modules_concurrently(self, modules):
+        dependencies = self.get_module_dependencies()
+        results = {}
+        pending = dict(modules)
+        executor = ThreadPoolExecutor(max_workers=self._module_concurrency)
+        try:
+            while pending:
+                # run every module whose requested dependencies are done
+                ready = [
+                    name
+                    for name in pending
+                    if not any(dep in pending for dep in dependencies.get(name, []))
+                ] or list(pending)
                 start = time.time()
-                for metric in generator():
-                    yield metric
-                end = time.time()
-                self.add_scrape_duration(name, end - start)
+                futures = {
+                    name: executor.submit(self._run_module, name, pending.pop(name))
+                    for name in ready
+                }
+                for name, future in futures.items():
+                    try:
+                        results[name] = future.result(timeout=self._remaining())
+                    except TimeoutError:
+                        # abandon the module, return what the others collected
+                        logging.warning(
+                            f"Collector {name} on {self._target} did not finish in time"
+                        )
+                        self._module_success[name] = 0
+                        results[name] = ([], time.time() - start)
+        finally:
+            executor.shutdown(wait=False)
+        # keep the output order independent of the module completion order
+        for name in modules:
+            metrics, duration = results[name]
+            yield name, metrics, duration
+
+    def collect_modules(self):
+        # Yields the name, the metrics and the duration of every module
+        modules = self.get_modules()
+        if self._module_concurrency:
+            yield from self._collect_modules_concurrently(modules)
+        else:
+            for name, generator in modules.items():
+                metrics, duration = self._run_module(name, generator)
+                yield name, metrics, duration
+
+    def collect_module_success(self):
+        module_success = GaugeMetricFamily(
+            "arista_module_success",
+            "Value 1 if the collector got all of its data in time",
+            labels=["collector"],
+        )
+        for name in self.get_modules():
+            if name in self._module_success:
+                module_success.add_metric([name], self._module_success[name])
+        return module_success
+
+    def collect_cache_ages(self):
+        cache_ages = GaugeMetricFamily(
+            "arista_module_cache_age_seconds",
+            "Age of the cached result of a collector, 0 if it was just fetched",
+            labels=["collector"],
+        )
+        for name in ["base"] + list(self.get_modules()):
+            if self._module_cache_ttl.get(name):
+                age = self._cached[name][1] if name in self._cached else 0
+                cache_ages.add_metric([name], age)
+        return cache_ages
+
+    def get_labels(self):
+        return dict(self._labels)
+
+    def is_up(self):
+        return self._switch_up == 1
+
+    def collect_base(self):
+        self._results = {}
+        self._answered = False
+        self._interface_index = None
+        self._cached = self._get_cached_modules()
+        self._module_success = {}
+        self._get_labels()
+        # Export the up and response metrics
+        yield up_metric(self._switch_up)
+
+        if self.is_up():
+            yield hw_metric(self._labels)
+
+    def collect(self):
+        yield from self.collect_base()
+        if self.is_up():
+            for name, metrics, duration in self.collect_modules():
+                yield from metrics
+                self.add_scrape_duration(name, duration)
         yield self._scrape_durations
+        if self._module_success:
+            yield self.collect_module_success()
+        if self._module_cache_ttl:
+            yield self.collect_cache_ages()
@@ -0,0 +1,226 @@
+from collections import OrderedDict
+
+import logging
+import os
+import threading
+import time
+
+import pyeapi
+
+from instrumentation import DECODE_DURATION, EAPI_DURATION, POOL_REQUESTS
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+class KeepAliveMixin(object):
+    # pyeapi closes the transport after every request. Keep the socket open
+    # for the next request unless the switch asked to close it.
+    _keep_open = False
+
+    def getresponse(self):
+        self._keep_open = False
+        response = super().getresponse()
+        self._keep_open = not response.will_close
+        return response
+
+    def close(self):
+        if not self._keep_open:
+            super().close()
+
+    def shutdown(self):
+        self._keep_open = False
+        self.close()
+
+
+class KeepAliveHttpConnection(KeepAliveMixin, pyeapi.eapilib.HttpConnection):
+    pass
+
+
+class KeepAliveHttpsConnection(KeepAliveMixin, pyeapi.eapilib.HttpsConnection):
+    pass
+
+
+class KeepAliveSocketConnection(KeepAliveMixin, pyeapi.eapilib.SocketConnection):
+    pass
+
+
+def connect(
+    protocol, host, username, password, timeout, keepalive=True, port=None, path=None
+):
+    if protocol == "socket":
+        # the local eAPI socket of EOS for an exporter running on the switch,
+        # it does not need credentials
+        connection = pyeapi.client.make_connection("socket", path=path, timeout=timeout)
+        if keepalive:
+            connection.transport = KeepAliveSocketConnection(
+                connection.transport.path, timeout=timeout
+            )
+        return connection
+    connection = pyeapi.connect(
+        transport=protocol,
+        host=host,
+        username=username,
+        password=password,
+        port=port,
+        timeout=timeout,
+    )
+    transport = connection.transport
+    if protocol == "https":
+        # workaround to allow sslv3 ciphers for python =>3.10
+        transport._context.set_ciphers("DEFAULT")
+        if keepalive:
+            connection.transport = KeepAliveHttpsConnection(
+                transport.path,
+                transport.host,
+                transport.port,
+                context=transport._context,
+                timeout=transport.timeout,
+            )
+    elif protocol == "http" and keepalive:
+        connection.transport = KeepAliveHttpConnection(
+            transport.path, transport.host, transport.port, timeout=transport.timeout
+        )
+    return connection
+
+
+def execute(connection, commands, label=None):
+    # Same as EapiConnection.execute from pyeapi, but decodes the response
+    # with orjson when it is installed. label is the command label of the
+    # request duration.
+    request = connection.request(commands, encoding="json").encode()
+    transport = connection.transport
+    command = label or (commands[0] if len(commands) == 1 else "batch")
+    try:
+        start = time.perf_counter()
+        transport.putrequest("POST", "/command-api")
+        transport.putheader("Content-type", "application/json-rpc")
+        transport.putheader("Content-length", str(len(request)))
+        if connection._auth:
+            transport.putheader(*connection._auth)
+        transport.endheaders(message_body=request)
+        response = transport.getresponse()
+        content = response.read()
+        EAPI_DURATION.labels(command).observe(time.perf_counter() - start)
+        if response.status == 401:
+            raise pyeapi.eapilib.ConnectionError(
+                str(connection), f"{response.reason}. {content}", commands
+            )
+        start = time.perf_counter()
+        decoded = json_loads(content)
+        DECODE_DURATION.observe(time.perf_counter() - start)
+    except OSError as e:
+        raise pyeapi.eapilib.ConnectionError(
+            str(connection), f"Socket error during eAPI connection: {e}", commands
+        )
+    except ValueError:
+        raise pyeapi.eapilib.ConnectionError(
+            str(connection), "unable to connect to eAPI", commands
+        )
+    finally:
+        transport.close()
+
+    if "error" in decoded:
+        code, message, error, output = connection._parse_error_message(decoded)
+        raise pyeapi.eapilib.CommandError(
+            code, message, command_error=error, output=output, commands=commands
+        )
+    return decoded
+
+
+def set_timeout(connection, timeout):
+    transport = connection.transport
+    transport.timeout = timeout
+    if transport.sock:
+        transport.sock.settimeout(timeout)
+
+
+def close(connection):
+    transport = connection.transport
+    if isinstance(transport, KeepAliveMixin):
+        transport.shutdown()
+    else:
+        transport.close()
+
+
+class ConnectionPool(object):
+    def __init__(self, max_size=256, idle_timeout=60):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # key -> list of (connection, last used), least recently used key first
+        self._idle = OrderedDict()
+        self._size = 0
+
+    def configure(self, max_size, idle_timeout):
+        with self._lock:
+            self._max_size = max_size
+            self._idle_timeout = idle_timeout
+        self.evict()
+
+    def acquire(self, key, factory):
+        # Returns the connection and whether it was reused from the pool
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                connection, last_used = idle.pop()
+                self._size -= 1
+                if not idle:
+                    del self._idle[key]
+                if time.time() - last_used < self._idle_timeout:
+                    POOL_REQUESTS.labels("hit").inc()
+                    return connection, True
+                close(connection)
+        POOL_REQUESTS.labels("miss").inc()
+        return factory(), False
+
+    def release(self, key, connection):
+        with self._lock:
+            self._idle.setdefault(key, []).append((connection, time.time()))
+            self._idle.move_to_end(key)
+            self._size += 1
+        self.evict()
+
+    def discard(self, connection):
+        logging.debug(f"Discarding connection {connection}")
+        close(connection)
+
+    def evict(self):
+        now = time.time()
+        evicted = []
+        with self._lock:
+            while self._idle:
+                key, idle = next(iter(self._idle.items()))
+                if self._size > self._max_size:
+                    evicted.append(idle.pop(0)[0])
+                elif now - idle[0][1] >= self._idle_timeout:
+                    evicted.append(idle.pop(0)[0])
+                else:
+                    break
+                self._size -= 1
+                if not idle:
+                    del self._idle[key]
+        for connection in evicted:
+            close(connection)
+
+    def reset(self):
+        # Forget the connections without closing them, they belong to the
+        # parent of a forked process
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()
+        self._size = 0
+
+    def clear(self):
+        with self._lock:
+            idle = [c for connections in self._idle.values() for c, _ in connections]
+            self._idle.clear()
+            self._size = 0
+        for connection in idle:
+            close(connection)
+
+
+POOL = ConnectionPool()
+# every worker process has its own connections to the switches
+os.register_at_fork(after_in_child=POOL.reset)
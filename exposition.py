@@ -0,0 +1,399 @@
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.metrics_core import Metric
+from prometheus_client.openmetrics.exposition import (
+    CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE,
+    generate_latest as generate_openmetrics,
+)
+from prometheus_client.samples import Sample
+from prometheus_client.utils import floatToGoString
+
+from array import array
+
+import struct
+import time
+import zlib
+
+from instrumentation import RENDER_DURATION
+
+PROTOBUF_CONTENT_TYPE = (
+    "application/vnd.google.protobuf; "
+    "proto=io.prometheus.client.MetricFamily; encoding=delimited"
+)
+# output format -> content type
+FORMATS = {
+    "text": CONTENT_TYPE_LATEST,
+    "openmetrics": OPENMETRICS_CONTENT_TYPE,
+    "protobuf": PROTOBUF_CONTENT_TYPE,
+}
+OPENMETRICS_EOF = b"# EOF\n"
+# MetricType of the protobuf format
+PROTOBUF_TYPES = {"counter": 0, "gauge": 1, "untyped": 3}
+# field of the value in the Metric message, by MetricType
+PROTOBUF_VALUE_FIELDS = {0: 3, 1: 2, 3: 5}
+
+
+class MetricList(object):
+    # Minimal registry that lets generate_latest render any list of metrics
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def collect(self):
+        return self._metrics
+
+
+def escape_label_value(value):
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+class LabelSet(object):
+    # Label values together with their exposition text, so that the labels
+    # of an interface are formatted once and shared by all of its samples
+    __slots__ = ("names", "values", "text", "_protobuf")
+
+    def __init__(self, names, values):
+        self.names = names
+        self.values = values
+        self._protobuf = None
+        # sorted by name like in generate_latest
+        self.text = ""
+        if names:
+            pairs = sorted(zip(names, values))
+            self.text = (
+                "{" + ",".join(f'{n}="{escape_label_value(v)}"' for n, v in pairs) + "}"
+            )
+
+    def as_dict(self):
+        return dict(zip(self.names, self.values))
+
+    def protobuf(self):
+        # the LabelPair fields of a Metric message, built on first use
+        if self._protobuf is None:
+            self._protobuf = _protobuf_labels(zip(self.names, self.values))
+        return self._protobuf
+
+
+class LabelCache(object):
+    # Interns the label sets of a target across scrapes, a label set is only
+    # built again when one of its values changed. Label sets that were not
+    # used since the previous rotate() are dropped.
+    __slots__ = ("_current", "_previous")
+
+    def __init__(self):
+        self._current = {}
+        self._previous = {}
+
+    def rotate(self):
+        self._previous = self._current
+        self._current = {}
+
+    def get(self, names, values):
+        key = (names, values)
+        label_set = self._current.get(key)
+        if label_set is None:
+            label_set = self._previous.get(key)
+            if label_set is None:
+                label_set = LabelSet(names, values)
+            self._current[key] = label_set
+        return label_set
+
+
+class LeanGaugeFamily(object):
+    # Gauge family that writes its exposition lines directly instead of
+    # building a Sample for every value
+    __slots__ = ("name", "documentation", "labels", "_label_sets", "_values")
+    type = "gauge"
+    suffix = ""
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._label_sets = []
+        self._values = array("d")
+
+    def add(self, label_set, value):
+        self._label_sets.append(label_set)
+        self._values.append(value)
+
+    def add_metric(self, labels, value):
+        self.add(LabelSet(self.labels, labels), value)
+
+    def items(self):
+        return zip(self._label_sets, self._values)
+
+    @property
+    def samples(self):
+        # for consumers that expect a prometheus_client metric family
+        return [
+            Sample(self.name + self.suffix, label_set.as_dict(), value)
+            for label_set, value in zip(self._label_sets, self._values)
+        ]
+
+    def expose(self):
+        name = self.name + self.suffix
+        documentation = self.documentation.replace("\\", r"\\").replace("\n", r"\n")
+        lines = [f"# HELP {name} {documentation}\n# TYPE {name} {self.type}\n"]
+        lines.extend(
+            f"{name}{label_set.text} {floatToGoString(value)}\n"
+            for label_set, value in zip(self._label_sets, self._values)
+        )
+        return "".join(lines).encode("utf-8")
+
+    def expose_openmetrics(self):
+        # the family of a counter is named without the _total of its samples
+        documentation = self.documentation.replace("\\", r"\\").replace("\n", r"\n")
+        documentation = documentation.replace('"', r"\"")
+        lines = [
+            f"# HELP {self.name} {documentation}\n# TYPE {self.name} {self.type}\n"
+        ]
+        name = self.name + self.suffix
+        lines.extend(
+            f"{name}{label_set.text} {floatToGoString(value)}\n"
+            for label_set, value in zip(self._label_sets, self._values)
+        )
+        return "".join(lines).encode("utf-8")
+
+    def expose_protobuf(self):
+        metric_type = PROTOBUF_TYPES[self.type]
+        field = PROTOBUF_VALUE_FIELDS[metric_type]
+        return _protobuf_family(
+            self.name + self.suffix,
+            self.documentation,
+            metric_type,
+            (
+                label_set.protobuf() + _protobuf_value(field, value)
+                for label_set, value in zip(self._label_sets, self._values)
+            ),
+        )
+
+
+class LeanCounterFamily(LeanGaugeFamily):
+    # Counter family, rendered like a CounterMetricFamily without the
+    # _created samples
+    __slots__ = ()
+    type = "counter"
+    suffix = "_total"
+
+
+def _varint(value):
+    data = bytearray()
+    while value > 0x7F:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _protobuf_field(number, data):
+    # a length delimited field: a string, bytes or a message
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def _protobuf_value(field, value):
+    # the Gauge, Counter or Untyped message with its double value
+    return _protobuf_field(field, b"\x09" + struct.pack("<d", value))
+
+
+def _protobuf_labels(pairs):
+    return b"".join(
+        _protobuf_field(
+            1,
+            _protobuf_field(1, name.encode("utf-8"))
+            + _protobuf_field(2, str(value).encode("utf-8")),
+        )
+        for name, value in sorted(pairs)
+    )
+
+
+def _protobuf_family(name, documentation, metric_type, metrics):
+    # A MetricFamily message with its varint length in front, the framing
+    # of the delimited encoding. Families without metrics are left out.
+    metrics = [_protobuf_field(4, metric) for metric in metrics]
+    if not metrics:
+        return b""
+    data = b"".join(
+        [
+            _protobuf_field(1, name.encode("utf-8")),
+            _protobuf_field(2, documentation.encode("utf-8")),
+            _varint(3 << 3) + _varint(metric_type),
+        ]
+        + metrics
+    )
+    return _varint(len(data)) + data
+
+
+def expose_protobuf(metric):
+    # A prometheus_client metric family in the protobuf format. Counters
+    # and info metrics are named like their samples, the _created samples
+    # and other types are exported untyped per sample name.
+    if metric.type in ("counter", "gauge"):
+        metric_type = PROTOBUF_TYPES[metric.type]
+        names = {metric.name + "_total" if metric.type == "counter" else metric.name}
+    elif metric.type in ("info", "stateset"):
+        metric_type = PROTOBUF_TYPES["gauge"]
+        names = {metric.name + "_info" if metric.type == "info" else metric.name}
+    else:
+        metric_type = PROTOBUF_TYPES["untyped"]
+        names = dict.fromkeys(sample.name for sample in metric.samples)
+    field = PROTOBUF_VALUE_FIELDS[metric_type]
+    return b"".join(
+        _protobuf_family(
+            name,
+            metric.documentation,
+            metric_type,
+            (
+                _protobuf_labels(sample.labels.items())
+                + _protobuf_value(field, sample.value)
+                for sample in metric.samples
+                if sample.name == name
+            ),
+        )
+        for name in names
+    )
+
+
+class RenderCache(object):
+    # The metrics of a module together with their output in every format
+    # they were served in. Used for results that are served more than once,
+    # they are rendered once per format.
+    __slots__ = ("metrics", "_output")
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._output = {}
+
+    def render(self, fmt="text"):
+        output = self._output.get(fmt)
+        if output is None:
+            output = self._output[fmt] = render(self.metrics, fmt)
+        return output
+
+
+def unpack(metrics):
+    # the metric families, with the ones of rendered modules
+    for metric in metrics:
+        if isinstance(metric, RenderCache):
+            yield from metric.metrics
+        else:
+            yield metric
+
+
+def merge_targets(results, label="target"):
+    # Combines the metrics of several targets into one family per metric
+    # name, with the target as an additional label
+    merged = {}
+    for target, metrics in results:
+        label_sets = {}
+        for metric in unpack(metrics):
+            family = merged.get(metric.name)
+            if family is None:
+                if isinstance(metric, LeanGaugeFamily):
+                    family = type(metric)(
+                        metric.name,
+                        metric.documentation,
+                        tuple(metric.labels) + (label,),
+                    )
+                else:
+                    family = Metric(metric.name, metric.documentation, metric.type)
+                merged[metric.name] = family
+            if isinstance(metric, LeanGaugeFamily) and type(family) is type(metric):
+                # label sets are shared between families, extend each once
+                for label_set, value in metric.items():
+                    extended = label_sets.get(id(label_set))
+                    if extended is None:
+                        extended = label_sets[id(label_set)] = LabelSet(
+                            tuple(label_set.names) + (label,),
+                            tuple(label_set.values) + (target,),
+                        )
+                    family.add(extended, value)
+            else:
+                for sample in metric.samples:
+                    family.add_sample(
+                        sample.name,
+                        dict(sample.labels, **{label: target}),
+                        sample.value,
+                        sample.timestamp,
+                    )
+    return list(merged.values())
+
+
+def render_metric(metric, fmt="text"):
+    if isinstance(metric, RenderCache):
+        return metric.render(fmt)
+    lean = isinstance(metric, LeanGaugeFamily)
+    if fmt == "protobuf":
+        return metric.expose_protobuf() if lean else expose_protobuf(metric)
+    if fmt == "openmetrics":
+        if lean:
+            return metric.expose_openmetrics()
+        # without the # EOF that ends every OpenMetrics exposition
+        return generate_openmetrics(MetricList([metric]))[: -len(OPENMETRICS_EOF)]
+    return metric.expose() if lean else generate_latest(MetricList([metric]))
+
+
+def render(metrics, fmt="text"):
+    return b"".join(render_metric(metric, fmt) for metric in metrics)
+
+
+def iter_render(metrics, fmt="text"):
+    # Render the metrics one by one, so the output can be sent while the
+    # next metrics are still being collected
+    duration = 0
+    for metric in metrics:
+        start = time.perf_counter()
+        output = render_metric(metric, fmt)
+        duration += time.perf_counter() - start
+        yield output
+    RENDER_DURATION.observe(duration)
+    if fmt == "openmetrics":
+        yield OPENMETRICS_EOF
+
+
+def negotiate(accept):
+    # Returns the format with the highest quality in the Accept header,
+    # text when the client accepts none of the others
+    best, best_quality = "text", 0
+    for media_range in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        params = dict(param.partition("=")[::2] for param in params)
+        try:
+            quality = float(params.get("q", 1))
+        except ValueError:
+            continue
+        media_type = media_type.lower()
+        if media_type == "application/vnd.google.protobuf":
+            if (
+                params.get("proto") != "io.prometheus.client.MetricFamily"
+                or params.get("encoding") != "delimited"
+            ):
+                continue
+            fmt = "protobuf"
+        elif media_type == "application/openmetrics-text":
+            fmt = "openmetrics"
+        elif media_type == "text/plain":
+            fmt = "text"
+        else:
+            continue
+        if quality > best_quality:
+            best, best_quality = fmt, quality
+    return best
+
+
+def accepts_gzip(accept_encoding):
+    for encoding in (accept_encoding or "").split(","):
+        name, _, params = encoding.partition(";")
+        if name.strip().lower() in ("gzip", "*") and params.strip() not in (
+            "q=0",
+            "q=0.0",
+        ):
+            return True
+    return False
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
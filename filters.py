@@ -0,0 +1,151 @@
+from functools import lru_cache
+
+import re
+
+# Lists of interface name regexes, or of exact names for the others. A
+# single string is taken as a list with one entry.
+LIST_SETTINGS = (
+    "interfaces",
+    "exclude_interfaces",
+    "exclude_interface_types",
+    "vrfs",
+    "bgp_peer_states",
+)
+FILTER_SETTINGS = LIST_SETTINGS + ("interface_range", "exclude_port_channel_members")
+
+# the interface range and the VRF names become part of the eAPI commands
+INTERFACE_RANGE = re.compile(r"^[A-Za-z][A-Za-z0-9/.,$-]*$")
+VRF_NAME = re.compile(r"^[\w.:-]+$")
+# Ethernet1/1.100 -> Ethernet, Port-Channel10 -> Port-Channel
+INTERFACE_TYPE = re.compile(r"^[A-Za-z-]*[A-Za-z]")
+# the BGP commands for one VRF -> the command for all VRFs
+BGP_COMMANDS = {
+    "show ip bgp summary": "show ip bgp summary vrf all",
+    "show ipv6 bgp summary": "show ipv6 bgp summary",
+}
+
+
+def get_filter_settings(config, target, params=None):
+    # The filters of a target: the global filters, overridden by the ones
+    # of the groups of the target, the ones of the target itself and then
+    # by the ones of the request
+    settings = dict(config.get("filters") or {})
+    target_filters = config.get("target_filters") or {}
+    for group, targets in (config.get("target_groups") or {}).items():
+        if group in target_filters and target in targets:
+            settings.update(target_filters[group])
+    settings.update(target_filters.get(target) or {})
+    settings.update(params or {})
+    return settings
+
+
+def make_filter(settings):
+    # Raises ValueError for unknown settings, invalid regexes and names
+    key = []
+    for name, value in sorted(settings.items()):
+        if name not in FILTER_SETTINGS:
+            raise ValueError(f"Unknown filter {name}")
+        if name in LIST_SETTINGS and value:
+            value = (value,) if isinstance(value, str) else tuple(map(str, value))
+        elif name == "interface_range" and value:
+            value = str(value)
+        if value:
+            key.append((name, value))
+    return _compile(tuple(key))
+
+
+@lru_cache(maxsize=256)
+def _compile(key):
+    return ScrapeFilter(dict(key), key)
+
+
+class ScrapeFilter(object):
+    # Restricts the interfaces, VRFs and BGP peers a scrape exports. The
+    # interface range and the VRFs are sent to the switch as part of the
+    # commands, the other filters are applied to the command output before
+    # any metric is built.
+    __slots__ = (
+        "key",
+        "include",
+        "exclude",
+        "types",
+        "members",
+        "interface_range",
+        "vrfs",
+        "peer_states",
+        "filters_interfaces",
+    )
+
+    def __init__(self, settings, key=()):
+        self.key = key
+        try:
+            self.include = [re.compile(p) for p in settings.get("interfaces", ())]
+            self.exclude = [
+                re.compile(p) for p in settings.get("exclude_interfaces", ())
+            ]
+        except re.error as e:
+            raise ValueError(f"Invalid interface regex: {e}")
+        self.types = frozenset(settings.get("exclude_interface_types", ()))
+        self.members = bool(settings.get("exclude_port_channel_members"))
+        self.interface_range = settings.get("interface_range")
+        if self.interface_range and not INTERFACE_RANGE.match(self.interface_range):
+            raise ValueError(f"Invalid interface range {self.interface_range}")
+        self.vrfs = settings.get("vrfs", ())
+        for vrf in self.vrfs:
+            if not VRF_NAME.match(vrf):
+                raise ValueError(f"Invalid VRF name {vrf}")
+        self.peer_states = frozenset(settings.get("bgp_peer_states", ()))
+        self.filters_interfaces = bool(
+            self.include or self.exclude or self.types or self.members
+        )
+
+    def __bool__(self):
+        return bool(self.key)
+
+    def interface(self, name, member=False):
+        # True if the metrics of the interface are exported
+        if not self.filters_interfaces:
+            return True
+        if self.include and not any(p.search(name) for p in self.include):
+            return False
+        if any(p.search(name) for p in self.exclude):
+            return False
+        if self.types:
+            match = INTERFACE_TYPE.match(name)
+            if match and match.group() in self.types:
+                return False
+        return not (member and self.members)
+
+    def vrf(self, name):
+        return not self.vrfs or name in self.vrfs
+
+    def peer_state(self, state):
+        return not self.peer_states or state in self.peer_states
+
+    def interface_command(self, command):
+        # "show interfaces status" -> "show interfaces Ethernet1-48 status"
+        if not self.interface_range:
+            return command
+        return command.replace(
+            "show interfaces", f"show interfaces {self.interface_range}", 1
+        )
+
+    def base_command(self, command):
+        # The command without the interface range and the VRF, for labels
+        # that must not depend on the parameters of a request
+        if self.interface_range:
+            command = command.replace(
+                f"show interfaces {self.interface_range}", "show interfaces", 1
+            )
+        if self.vrfs:
+            command = BGP_COMMANDS.get(command.partition(" vrf ")[0], command)
+        return command
+
+    def bgp_commands(self):
+        # Returns the IPv4 and the IPv6 commands
+        if not self.vrfs:
+            return ["show ip bgp summary vrf all"], ["show ipv6 bgp summary"]
+        return (
+            [f"show ip bgp summary vrf {vrf}" for vrf in self.vrfs],
+            [f"show ipv6 bgp summary vrf {vrf}" for vrf in self.vrfs],
+        )
@@ -1,61 +1,355 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cProfile
+import io
 import logging
+import pstats
 import re
 import socket
+import time
+import urllib.error
+import urllib.request
 
 import falcon
 
-from collector import AristaMetricsCollector
+from cache import SingleFlight
+from cluster import FORWARDED_PARAM
+from collector import AristaMetricsCollector, up_metric
+
+from exposition import (
+    FORMATS,
+    accepts_gzip,
+    gzip_chunks,
+    iter_render,
+    merge_targets,
+    negotiate,
+)
+from filters import LIST_SETTINGS, make_filter
+from health import check_dns
+from instrumentation import CLUSTER_REQUESTS, REGISTRY, RESPONSE_BYTES
+from instrumentation import SCRAPES_IN_FLIGHT
+from plan import PlanResolver
+
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+
+
+def track(chunks):
+    # the scrape is in flight until all of its output was sent
+    SCRAPES_IN_FLIGHT.inc()
+    try:
+        for chunk in chunks:
+            RESPONSE_BYTES.inc(len(chunk))
+            yield chunk
+    finally:
+        SCRAPES_IN_FLIGHT.dec()
+
 
-from prometheus_client.exposition import CONTENT_TYPE_LATEST
-from prometheus_client.exposition import generate_latest
+# scrapes between the replicas never go through an HTTP proxy
+PEER_OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def relay(response):
+    try:
+        yield from iter(lambda: response.read(65536), b"")
+    finally:
+        response.close()
 
 
 class metricHandler:
-    def __init__(self, config):
+    def __init__(self, config, poller=None, health=None, cluster=None):
         self._config = config
-        self._target = None
+        self._poller = poller
+        self._health = health
+        self._cluster = cluster
+        self._plans = PlanResolver(config)
+        # on the switch the exporter only reads the local eAPI socket
+        self._on_box = config.get("protocol") == "socket"
+        # concurrent scrapes of the same target share one collection
+        self._flights = SingleFlight(ttl=config.get("coalesce_ttl", 0))
 
-    def handle_modules(self, modules):
-        if not modules:
-            return False
-        module_functions = []
-        modules = modules.split(",")
-        for module in modules:
-            if module == "all":
-                return False
-            elif module == "memory":
-                module.functions
+    def get_timeout(self, req):
+        # Finish before Prometheus gives up on the scrape
+        timeout = self._config["timeout"]
+        scrape_timeout = req.get_header("X-Prometheus-Scrape-Timeout-Seconds")
+        if scrape_timeout:
+            try:
+                scrape_timeout = float(scrape_timeout)
+            except ValueError:
+                logging.warning(f"Invalid scrape timeout header: {scrape_timeout}")
+            else:
+                offset = self._config.get("scrape_timeout_offset", 0.5)
+                timeout = min(timeout, max(scrape_timeout - offset, 0.1))
+        return timeout
 
-    def on_get(self, req, resp):
-        self._target = req.get_param("target")
+    def get_params(self, req, resp):
+        # Returns the modules and the filter parameters of the request, or
+        # None after answering an invalid request with 400
         modules = req.get_param("modules")
         if modules:
-            if re.match(r"^([a-zA-Z]+)(,[a-zA-Z]+)*$", modules):
-                self._config["module_names"] = modules
-            else:
+            if not re.match(r"^([a-zA-Z]+)(,[a-zA-Z]+)*$", modules):
                 msg = "Invalid modules specified"
                 logging.error(msg)
                 resp.status = falcon.HTTP_400
-                resp.body = msg
+                resp.text = msg
+                return None
+        try:
+            filters = self.get_filter_params(req)
+        except ValueError as e:
+            msg = f"Invalid filter: {e}"
+            logging.error(msg)
+            resp.status = falcon.HTTP_400
+            resp.text = msg
+            return None
+        return modules, filters
+
+    def get_filter_params(self, req):
+        # Filters in the query replace the ones from the config. Regexes
+        # can contain commas, they are given as repeated parameters.
+        params = {}
+        for name in LIST_SETTINGS:
+            values = req.get_param_as_list(name)
+            if values and name not in ("interfaces", "exclude_interfaces"):
+                values = [v for value in values for v in value.split(",") if v]
+            if values:
+                params[name] = values
+        if req.has_param("interface_range"):
+            params["interface_range"] = req.get_param("interface_range")
+        members = req.get_param_as_bool("exclude_port_channel_members")
+        if members is not None:
+            params["exclude_port_channel_members"] = members
+        # raises ValueError for invalid filters
+        make_filter(params)
+        return params
+
+    def forward(self, req, resp, owner):
+        # Sends the scrape to the replica that owns the target, so its
+        # connections and caches stay on one replica. Returns False when the
+        # owner did not answer, the target is then scraped here.
+        url = self._cluster.forward_url(owner, req.relative_uri)
+        if self._cluster.mode == "redirect":
+            CLUSTER_REQUESTS.labels("redirected").inc()
+            resp.status = falcon.HTTP_307
+            resp.location = url
+            return True
+        headers = {}
+        for name in [
+            "Accept",
+            "Accept-Encoding",
+            "X-Prometheus-Scrape-Timeout-Seconds",
+        ]:
+            if req.get_header(name):
+                headers[name] = req.get_header(name)
+        timeout = self.get_timeout(req) + self._config.get("scrape_timeout_offset", 0.5)
+        try:
+            response = PEER_OPENER.open(
+                urllib.request.Request(url, headers=headers), timeout=timeout
+            )
+        except urllib.error.HTTPError as e:
+            response = e
+        except OSError as e:
+            logging.warning(f"Owner {owner} did not answer, scraping here: {e}")
+            CLUSTER_REQUESTS.labels("fallback").inc()
+            return False
+        CLUSTER_REQUESTS.labels("proxied").inc()
+        # the body is passed on as it is, compressed if the client asked so
+        resp.status = response.status
+        resp.content_type = response.headers.get("Content-Type")
+        if response.headers.get("Content-Encoding"):
+            resp.set_header("Content-Encoding", response.headers["Content-Encoding"])
+        resp.vary = ["Accept", "Accept-Encoding"]
+        resp.stream = relay(response)
+        return True
+
+    def send(self, req, resp, chunks):
+        # Stream the metrics to the client as they are rendered
+        resp.vary = ["Accept", "Accept-Encoding"]
+        chunks = track(chunks)
+        if self._config.get("compress_response", True) and accepts_gzip(
+            req.get_header("Accept-Encoding")
+        ):
+            resp.set_header("Content-Encoding", "gzip")
+            chunks = gzip_chunks(chunks)
+        resp.stream = iter(chunks)
+
+    def profile(self, resp, profiler, scrape):
+        # Runs the scrape in a profiler and returns its report instead of
+        # the metrics. Only the request thread is profiled.
+        if not self._config.get("profiling", False):
+            resp.status = falcon.HTTP_403
+            resp.text = "Profiling is disabled"
+            return
+        if profiler == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                resp.status = falcon.HTTP_400
+                resp.text = "pyinstrument is not installed"
                 return
+            profile = Profiler()
+            profile.start()
+            b"".join(scrape())
+            profile.stop()
+            report = profile.output_text()
+        else:
+            profile = cProfile.Profile()
+            profile.runcall(lambda: b"".join(scrape()))
+            output = io.StringIO()
+            stats = pstats.Stats(profile, stream=output)
+            stats.sort_stats("cumulative").print_stats(50)
+            report = output.getvalue()
+        resp.content_type = falcon.MEDIA_TEXT
+        resp.text = report
 
-        resp.set_header("Content-Type", CONTENT_TYPE_LATEST)
-        if not self._target:
+    def on_get(self, req, resp):
+        # Requests can be served concurrently, the request state is kept in
+        # the scrape plan
+        target = req.get_param("target")
+        if not target and self._on_box:
+            target = "localhost"
+        params = self.get_params(req, resp)
+        if params is None:
+            return
+        modules, filters = params
+
+        fmt = negotiate(req.get_header("Accept"))
+        resp.set_header("Content-Type", FORMATS[fmt])
+        if not target:
             msg = "No target parameter provided!"
             logging.error(msg)
             resp.status = falcon.HTTP_400
-            resp.body = msg
+            resp.text = msg
+            return
+
+        if self._cluster:
+            owner = self._cluster.owner(target)
+            forwarded = req.get_param(FORWARDED_PARAM)
+            if owner != self._cluster.url and not forwarded:
+                if self.forward(req, resp, owner):
+                    return
+            CLUSTER_REQUESTS.labels("local").inc()
+
+        # polled targets are collected with the filters from the config
+        polled = self._poller and self._poller.has_target(target)
+        if polled and not filters:
+            collected_metric = self._poller.exposition(target, modules, fmt)
+            if collected_metric is not None:
+                self.send(req, resp, [collected_metric])
+                return
+            logging.debug(f"No polled data for {target} yet, scraping directly")
 
         try:
-            socket.getaddrinfo(self._target, None)
+            if not self._on_box:
+                check_dns(target, self._config.get("dns_cache_ttl", 60))
         except socket.gaierror as e:
             msg = f"Target does not exist in DNS: {e}"
             logging.error(msg)
             resp.status = falcon.HTTP_400
-            resp.body = msg
+            resp.text = msg
 
         else:
-            registry = AristaMetricsCollector(self._config, target=self._target)
+            if self._health and self._health.is_open(target):
+                self.send(req, resp, iter_render(self._health.metrics(target), fmt))
+                return
+            plan = self._plans.resolve(
+                target, modules, timeout=self.get_timeout(req), filters=filters
+            )
+
+            def scrape():
+                registry = AristaMetricsCollector(self._config, plan)
+                metrics = registry.collect()
+                if self._health:
+                    metrics = self._health.observe(target, registry, metrics)
+                return iter_render(metrics, fmt)
+
+            profiler = req.get_param("profile")
+            if profiler:
+                self.profile(resp, profiler, scrape)
+                return
+            key = (target, plan.modules, plan.filter.key, fmt)
+            self.send(req, resp, self._flights.stream(key, scrape))
+
+
+class multiTargetHandler(metricHandler):
+    # Scrapes several targets in parallel and returns their metrics in one
+    # exposition with an additional target label
+    def __init__(self, config, poller=None, health=None):
+        super().__init__(config, poller, health)
+        self._groups = config.get("target_groups") or {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.get("multi_target_concurrency", 16),
+            thread_name_prefix="multi",
+        )
+
+    def get_targets(self, req):
+        group = req.get_param("group")
+        if group:
+            return self._groups.get(group)
+        targets = req.get_param("targets")
+        if targets:
+            return [target for target in targets.split(",") if target]
+        return None
 
-            collected_metric = generate_latest(registry)
-            resp.body = collected_metric
+    def scrape(self, plan, polled=False):
+        target = plan.target
+        if polled:
+            # polled targets are served from the poller like on /arista
+            metrics = self._poller.metrics(target, plan.modules)
+            if metrics is not None:
+                return metrics
+            logging.debug(f"No polled data for {target} yet, scraping directly")
+        if self._health and self._health.is_open(target):
+            return self._health.metrics(target)
+        collector = AristaMetricsCollector(self._config, plan)
+        metrics = collector.collect()
+        if self._health:
+            metrics = self._health.observe(target, collector, metrics)
+        return list(metrics)
+
+    def on_get(self, req, resp):
+        params = self.get_params(req, resp)
+        if params is None:
+            return
+        modules, filters = params
+
+        fmt = negotiate(req.get_header("Accept"))
+        resp.set_header("Content-Type", FORMATS[fmt])
+        targets = self.get_targets(req)
+        if not targets:
+            msg = "No targets or unknown group provided!"
+            logging.error(msg)
+            resp.status = falcon.HTTP_400
+            resp.text = msg
+            return
+
+        # All targets share the deadline of the whole request
+        timeout = self.get_timeout(req)
+        deadline = time.time() + timeout
+        futures = {
+            target: self._executor.submit(
+                self.scrape,
+                self._plans.resolve(target, modules, timeout, deadline, filters),
+                not filters and self._poller and self._poller.has_target(target),
+            )
+            for target in dict.fromkeys(targets)
+        }
+        wait(futures.values(), timeout=max(deadline - time.time(), 0))
+
+        results = []
+        for target, future in futures.items():
+            if future.done() and future.exception() is None:
+                results.append((target, future.result()))
+            else:
+                if not future.done():
+                    future.cancel()
+                    logging.warning(f"Scrape of {target} did not finish in time")
+                else:
+                    logging.error(f"Scrape of {target} failed: {future.exception()}")
+                results.append((target, [up_metric(0)]))
+        self.send(req, resp, iter_render(merge_targets(results), fmt))
+
+
+class selfMetricsHandler:
+    # Metrics about the exporter itself
+    def on_get(self, req, resp):
+        resp.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        resp.data = generate_latest(REGISTRY)
@@ -0,0 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client.core import GaugeMetricFamily
+
+import logging
+import socket
+import threading
+import time
+
+from cache import TTLCache
+from collector import AristaMetricsCollector, hw_metric, up_metric
+from plan import PlanResolver
+
+# target -> None or the arguments of the socket.gaierror of the lookup
+DNS_CACHE = TTLCache()
+
+
+def check_dns(target, ttl=60):
+    # socket.getaddrinfo with the result kept for ttl seconds. Failed
+    # lookups are kept as well, so a missing name does not reach the
+    # resolver on every scrape.
+    entry = DNS_CACHE.get_entry(target, ttl) if ttl else None
+    if entry is None:
+        try:
+            socket.getaddrinfo(target, None)
+            error = None
+        except socket.gaierror as e:
+            error = e.args
+        DNS_CACHE.set(target, error)
+    else:
+        error = entry[0]
+    if error is not None:
+        raise socket.gaierror(*error)
+
+
+class _Breaker(object):
+    __slots__ = ("failures", "open", "backoff", "next_probe", "requested", "probing")
+
+    def __init__(self):
+        self.failures = 0
+        self.open = False
+        self.backoff = 0
+        self.next_probe = 0
+        self.requested = 0
+        self.probing = False
+
+
+class HealthTracker(object):
+    # A circuit breaker per target. After breaker_failures scrapes in a row
+    # found a switch down, its scrapes are answered at once with arista_up 0
+    # and the last known labels, instead of waiting for the timeout. The
+    # switch is probed in the background with an exponential backoff and
+    # scraped normally again after a probe reached it.
+    def __init__(self, config):
+        self._config = config
+        self._plans = PlanResolver(config)
+        self._failures = config["breaker_failures"]
+        self._backoff = config.get("breaker_backoff", 30)
+        self._max_backoff = config.get("breaker_max_backoff", 600)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # target -> _Breaker, only for targets that failed
+        self._breakers = {}
+        # target -> labels of arista_hw from the last successful scrape
+        self._labels = TTLCache()
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.get("breaker_probe_workers", 4),
+            thread_name_prefix="probe",
+        )
+        self._thread = threading.Thread(target=self._run, name="breaker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._executor.shutdown(wait=False)
+
+    def is_open(self, target):
+        with self._lock:
+            breaker = self._breakers.get(target)
+            if breaker is None or not breaker.open:
+                return False
+            breaker.requested = time.time()
+            return True
+
+    def metrics(self, target):
+        # The answer to a scrape of a target with an open breaker
+        metrics = [up_metric(0)]
+        labels = self._labels.get(target, float("inf"))
+        if labels:
+            metrics.append(hw_metric(labels))
+        metrics.append(
+            GaugeMetricFamily(
+                "arista_breaker_open",
+                "The switch is not scraped after repeated failures",
+                value=1,
+            )
+        )
+        return metrics
+
+    def record(self, target, up, labels=None):
+        if up:
+            if labels:
+                self._labels.set(target, labels)
+            with self._lock:
+                self._breakers.pop(target, None)
+            return
+        with self._lock:
+            breaker = self._breakers.setdefault(target, _Breaker())
+            breaker.failures += 1
+            if breaker.open or breaker.failures < self._failures:
+                return
+            breaker.open = True
+            breaker.backoff = self._backoff
+            breaker.requested = breaker.next_probe = time.time()
+            breaker.next_probe += breaker.backoff
+        logging.warning(
+            f"Switch {target} failed {breaker.failures} scrapes, "
+            f"probing it every {breaker.backoff}s"
+        )
+
+    def observe(self, target, collector, metrics):
+        # Passes the metrics of a scrape through and records its result
+        yield from metrics
+        self.record(target, collector.is_up(), collector.get_labels())
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.time()
+            with self._lock:
+                due = []
+                for target, breaker in list(self._breakers.items()):
+                    if not breaker.open or breaker.probing:
+                        continue
+                    if now - breaker.requested > self._max_backoff:
+                        # nobody scrapes the target anymore
+                        del self._breakers[target]
+                    elif breaker.next_probe <= now:
+                        breaker.probing = True
+                        due.append(target)
+            for target in due:
+                self._executor.submit(self.probe, target)
+            self._stop.wait(1)
+
+    def probe(self, target):
+        # Fetches only the switch info, without the module cache, which
+        # could answer for the switch
+        collector = AristaMetricsCollector(
+            dict(self._config, module_cache_ttl=None),
+            self._plans.resolve(target, module_names=""),
+        )
+        try:
+            list(collector.collect_base())
+            up = collector.is_up()
+        except Exception:
+            logging.exception(f"Probing switch {target} failed")
+            up = False
+        if up:
+            logging.info(f"Switch {target} is reachable again")
+            self.record(target, True, collector.get_labels())
+            return
+        with self._lock:
+            breaker = self._breakers.get(target)
+            if breaker is None:
+                return
+            breaker.probing = False
+            breaker.backoff = min(breaker.backoff * 2, self._max_backoff)
+            breaker.next_probe = time.time() + breaker.backoff
@@ -0,0 +1,65 @@
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import ProcessCollector
+
+# Metrics about the exporter itself, served on /metrics. They are kept out of
+# the default registry so they never mix with the metrics of a switch.
+REGISTRY = CollectorRegistry()
+ProcessCollector(registry=REGISTRY)
+
+# most of the CPU work of a scrape takes milliseconds
+CPU_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+EAPI_DURATION = Histogram(
+    "arista_exporter_eapi_request_seconds",
+    "Round trip time of eAPI requests, batched requests have the command batch",
+    ["command"],
+    registry=REGISTRY,
+)
+DECODE_DURATION = Histogram(
+    "arista_exporter_decode_seconds",
+    "Time spent decoding the JSON of eAPI responses",
+    registry=REGISTRY,
+    buckets=CPU_BUCKETS,
+)
+BUILD_DURATION = Histogram(
+    "arista_exporter_build_seconds",
+    "Time spent building the metrics of a collector",
+    ["collector"],
+    registry=REGISTRY,
+    buckets=CPU_BUCKETS,
+)
+RENDER_DURATION = Histogram(
+    "arista_exporter_render_seconds",
+    "Time spent rendering the metrics of a scrape",
+    registry=REGISTRY,
+    buckets=CPU_BUCKETS,
+)
+RESPONSE_BYTES = Counter(
+    "arista_exporter_response_bytes",
+    "Bytes of rendered metrics before compression",
+    registry=REGISTRY,
+)
+SCRAPES_IN_FLIGHT = Gauge(
+    "arista_exporter_scrapes_in_flight",
+    "Number of scrapes being served",
+    registry=REGISTRY,
+)
+POOL_REQUESTS = Counter(
+    "arista_exporter_connection_pool_requests",
+    "Connections taken from the pool (hit) or newly created (miss)",
+    ["result"],
+    registry=REGISTRY,
+)
+CLUSTER_REQUESTS = Counter(
+    "arista_exporter_cluster_requests",
+    "Scrapes served here (local), proxied or redirected to the owner of the "
+    "target, or served here because the owner did not answer (fallback)",
+    ["result"],
+    registry=REGISTRY,
+)
+EAPI_ERRORS = Counter(
+    "arista_exporter_eapi_errors",
+    "Failed eAPI requests by type of error",
+    ["type"],
+    registry=REGISTRY,
+)
@@ -0,0 +1,42 @@
+class InterfaceIndex(object):
+    # The configured interfaces of a switch with their descriptions, and the
+    # configured lanes of every port. Built once from the interface list of
+    # a scrape and shared by all modules that report per interface.
+    __slots__ = ("descriptions", "lanes")
+
+    def __init__(self, descriptions):
+        self.descriptions = descriptions
+        # parent port -> [(lane number, interface)] in lane order
+        self.lanes = {}
+        for name in descriptions:
+            parent, _, lane = name.rpartition("/")
+            if parent and lane.isdigit():
+                self.lanes.setdefault(parent, []).append((int(lane), name))
+        for lanes in self.lanes.values():
+            lanes.sort()
+
+    def __contains__(self, name):
+        return name in self.descriptions
+
+    def description(self, name):
+        return self.descriptions.get(name, "")
+
+    def resolve(self, name, serials):
+        # Returns the interface a transceiver lane belongs to: the lane
+        # itself if it is configured, otherwise the closest configured lane
+        # before it on the same port with the same transceiver serial. For
+        # example Ethernet1/2 to Ethernet1/4 of a 100G port belong to
+        # Ethernet1/1.
+        if name in self.descriptions:
+            return name
+        parent, _, lane = name.rpartition("/")
+        serial = serials.get(name)
+        if not lane.isdigit() or serial is None:
+            return name
+        owner = name
+        for number, interface in self.lanes.get(parent, ()):
+            if number > int(lane):
+                break
+            if serials.get(interface) == serial:
+                owner = interface
+        return owner
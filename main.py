@@ -2,59 +2,269 @@
 
 import argparse
 import logging
+import signal
 import socket
 import sys
+import threading
 import yaml
 
 import falcon
-from handler import metricHandler
+from concurrent.futures import ThreadPoolExecutor
+from cluster import Cluster
+from connections import POOL
+from filters import make_filter
+from health import HealthTracker
+from handler import metricHandler, multiTargetHandler, selfMetricsHandler
+from poller import Poller
+from workers import WorkerSupervisor
 from wsgiref import simple_server
 
 
+class PooledWSGIServer(simple_server.WSGIServer):
+    # Serve every request in a bounded pool of threads so that a slow switch
+    # does not block the scrapes of the other targets.
+    # server_close() does not wait for the running requests, unlike
+    # ThreadingMixIn. run_worker() turns it on to finish them on SIGTERM.
+    block_on_close = False
+
+    def __init__(
+        self, server_address, handler_class, workers, backlog, bind_and_activate=True
+    ):
+        self.request_queue_size = backlog
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="scrape"
+        )
+        # a connection is only accepted when a worker is free, the others
+        # wait in the listen backlog and are refused when it is full
+        self._slots = threading.BoundedSemaphore(workers)
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def get_request(self):
+        self._slots.acquire()
+        try:
+            return super().get_request()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def verify_request(self, request, client_address):
+        if super().verify_request(request, client_address):
+            return True
+        self._slots.release()
+        return False
+
+    def process_request(self, request, client_address):
+        try:
+            self._executor.submit(self.process_request_thread, request, client_address)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=self.block_on_close)
+
+
+def use_socket(httpd, sock):
+    # serve on a socket that was bound by the worker supervisor
+    httpd.socket.close()
+    httpd.socket = sock
+    host, port = httpd.server_address = sock.getsockname()[:2]
+    httpd.server_name = socket.getfqdn(host)
+    httpd.server_port = port
+    httpd.setup_environ()
+
+
+def make_server(config, addr, port, api, sock=None):
+    if config["server_workers"] <= 1:
+        httpd = simple_server.WSGIServer(
+            (addr, port),
+            simple_server.WSGIRequestHandler,
+            bind_and_activate=sock is None,
+        )
+    else:
+        httpd = PooledWSGIServer(
+            (addr, port),
+            simple_server.WSGIRequestHandler,
+            workers=config["server_workers"],
+            backlog=config["listen_backlog"],
+            bind_and_activate=sock is None,
+        )
+    if sock is not None:
+        use_socket(httpd, sock)
+    httpd.set_app(api)
+    return httpd
+
+
+def make_app(config):
+    POOL.configure(config["connection_pool_size"], config["connection_idle_timeout"])
+    if config["eapi_client"] == "async":
+        # the event loop and its SSL context are only loaded when used
+        from async_eapi import CLIENT, make_ssl_context
+
+        CLIENT.configure(
+            config["connection_pool_size"],
+            config["connection_idle_timeout"],
+            make_ssl_context(
+                verify=not config["disable_certificate_validation"],
+                ca_file=config.get("ssl_ca_file"),
+                ciphers=config.get("ssl_ciphers", "DEFAULT"),
+            ),
+        )
+    cluster = None
+    if config.get("cluster_peers"):
+        cluster = Cluster(config)
+        # every replica polls the targets it owns
+        config = dict(
+            config,
+            poll_targets=[
+                target
+                for target in config.get("poll_targets") or []
+                if cluster.is_local(target)
+            ],
+        )
+    poller = None
+    if config.get("poll_targets"):
+        poller = Poller(config)
+        poller.start()
+    health = None
+    if config.get("breaker_failures"):
+        health = HealthTracker(config)
+        health.start()
+    api = falcon.App()
+    api.add_route(
+        "/arista",
+        metricHandler(config=config, poller=poller, health=health, cluster=cluster),
+    )
+    api.add_route(
+        "/arista/multi",
+        multiTargetHandler(config=config, poller=poller, health=health),
+    )
+    api.add_route("/metrics", selfMetricsHandler())
+
+    def stop():
+        # stops the background threads and closes the idle connections
+        for service in (poller, health):
+            if service:
+                service.stop()
+        POOL.clear()
+
+    return api, stop
+
+
+def run_worker(config, sock):
+    # Runs in a worker process until the supervisor sends SIGTERM, then
+    # finishes the requests in progress
+    api, stop_app = make_app(config)
+    httpd = make_server(config, config["listen_addr"], config["listen_port"], api, sock)
+    httpd.block_on_close = True
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), which runs in this thread
+        threading.Thread(target=httpd.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    httpd.serve_forever()
+    httpd.server_close()
+    stop_app()
+
+
 def falcon_app(config, logger, port=9200, addr="0.0.0.0"):
     logger.info(f"Starting Arista eAPI exporter on Port {addr}:{port}")
-    api = falcon.App()
-    api.add_route("/arista", metricHandler(config=config))
+    api, stop_app = make_app(config)
 
     try:
-        httpd = simple_server.make_server(addr, port, api)
+        httpd = make_server(config, addr, port, api)
     except Exception as e:
         logger.error(f"Couldn't start Server: {e}")
+        stop_app()
         return 1
 
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         httpd.server_close()
+        stop_app()
         logger.info("Stopping Arista eAPI Prometheus Server")
 
 
-def main():
-    # command line options
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-c",
-        "--config",
-        help="Specify config yaml file",
-        metavar="FILE",
-        required=False,
-        default="config.yml",
+def prefork(config, logger):
+    addr, port = config["listen_addr"], config["listen_port"]
+    logger.info(f"Starting Arista eAPI exporter on Port {addr}:{port}")
+    try:
+        sock = socket.create_server((addr, port), backlog=config["listen_backlog"])
+    except Exception as e:
+        logger.error(f"Couldn't start Server: {e}")
+        return 1
+    # All workers wake up for a new connection and only one gets it. With a
+    # blocking socket the others would wait in accept() and not notice a
+    # shutdown() until the next connection.
+    sock.setblocking(False)
+    supervisor = WorkerSupervisor(
+        config, sock, run_worker, lambda: load_config(config["config_file"])
     )
-    args = parser.parse_args()
+    supervisor.run()
+    logger.info("Stopping Arista eAPI Prometheus Server")
 
-    # get the config
+
+def load_config(filename):
+    # Returns the config with its defaults, or None if it is not usable
     try:
-        with open(args.config, "r") as stream:
+        with open(filename, "r") as stream:
             config = yaml.safe_load(stream)
     except FileNotFoundError:
-        logging.error(f"File not found: {args.config}")
-        return 1
+        logging.error(f"File not found: {filename}")
+        return None
+    config["config_file"] = filename
     if "listen_addr" not in config:
         config["listen_addr"] = "0.0.0.0"
 
+    if "server_workers" not in config:
+        config["server_workers"] = 1
+    if "worker_processes" not in config:
+        config["worker_processes"] = 1
+    if "listen_backlog" not in config:
+        config["listen_backlog"] = 128
+    if "scrape_timeout_offset" not in config:
+        config["scrape_timeout_offset"] = 0.5
+
+    if "coalesce_ttl" not in config:
+        config["coalesce_ttl"] = 0
+
+    on_box = config.get("protocol") == "socket"
+    if on_box:
+        # Running on the switch: the only target is the switch itself, one
+        # connection per server worker is kept for the life of the process
+        if "connection_pool_size" not in config:
+            config["connection_pool_size"] = config["server_workers"]
+        if "connection_idle_timeout" not in config:
+            config["connection_idle_timeout"] = float("inf")
+    if "connection_pool_size" not in config:
+        config["connection_pool_size"] = 256
+    if "connection_idle_timeout" not in config:
+        config["connection_idle_timeout"] = 60
+
     if "disable_certificate_validation" not in config:
         config["disable_certificate_validation"] = False
-    if config["disable_certificate_validation"] is not True:
+    if "eapi_client" not in config:
+        config["eapi_client"] = "pyeapi"
+    if on_box and config["eapi_client"] == "async":
+        logging.error("The async eAPI client does not support protocol: socket")
+        return None
+    if (
+        config["disable_certificate_validation"] is not True
+        and config["eapi_client"] != "async"
+        and not on_box
+    ):
         logging.error(
             (
                 "Certificate validation is not supported by pyeapi"
@@ -64,6 +274,46 @@ def main():
                 "https://github.com/arista-eosplus/pyeapi/issues/174"
             )
         )
+        return None
+
+    if config["worker_processes"] > 1 and config.get("poll_targets"):
+        logging.error("Background polling does not support worker_processes > 1")
+        return None
+    if config.get("cluster_peers"):
+        peers = [peer.rstrip("/") for peer in config["cluster_peers"]]
+        if str(config.get("cluster_self", "")).rstrip("/") not in peers:
+            logging.error("cluster_self must be one of the cluster_peers")
+            return None
+        if config.get("cluster_mode", "proxy") not in ("proxy", "redirect"):
+            logging.error("cluster_mode must be proxy or redirect")
+            return None
+    filters = [config.get("filters") or {}]
+    filters.extend((config.get("target_filters") or {}).values())
+    try:
+        for settings in filters:
+            make_filter(settings or {})
+    except ValueError as e:
+        logging.error(f"Invalid filter in the config: {e}")
+        return None
+    return config
+
+
+def main():
+    # command line options
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="Specify config yaml file",
+        metavar="FILE",
+        required=False,
+        default="config.yml",
+    )
+    args = parser.parse_args()
+
+    # get the config
+    config = load_config(args.config)
+    if config is None:
         return 1
 
     # enable logging
@@ -79,6 +329,8 @@ def main():
     )
     logging.basicConfig(stream=sys.stdout, format=format)
 
+    if config["worker_processes"] > 1:
+        return prefork(config, logger)
     falcon_app(config, logger, port=config["listen_port"], addr=config["listen_addr"])
 
 
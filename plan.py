@@ -0,0 +1,86 @@
+from functools import lru_cache
+from typing import NamedTuple
+
+import logging
+import os
+import time
+
+from filters import ScrapeFilter, get_filter_settings, make_filter
+
+# the collectors of a switch in the order of the output
+MODULES = ("memory", "tcam", "port", "sfp", "bgp", "power")
+# the modules share their interface data through the interface index,
+# none of them needs another module to run first
+MODULE_DEPENDENCIES = {}
+
+
+class ScrapePlan(NamedTuple):
+    # Everything that differs between two scrapes. A plan is built per
+    # request and never changed, so concurrent scrapes do not share any
+    # state through the config.
+    target: str
+    modules: tuple
+    timeout: float
+    deadline: float
+    username: str
+    password: str
+    filter: ScrapeFilter
+
+
+@lru_cache(maxsize=256)
+def parse_modules(module_names):
+    # "port,sfp" -> the requested modules, each after the requested modules
+    # it depends on. None and "all" request all modules.
+    if module_names is None:
+        return MODULES
+    requested = []
+    for module in module_names.split(","):
+        if not module or module in requested:
+            continue
+        if module == "all":
+            return MODULES
+        if module in MODULES:
+            requested.append(module)
+        else:
+            logging.warning(f"Unknown module requested:{module}. Ignoring")
+
+    ordered = []
+
+    def add(name):
+        if name in ordered:
+            return
+        for dependency in MODULE_DEPENDENCIES.get(name, []):
+            if dependency in requested:
+                add(dependency)
+        ordered.append(name)
+
+    for name in requested:
+        add(name)
+    return tuple(ordered)
+
+
+class PlanResolver(object):
+    # Builds the scrape plans of the requests from the config
+    def __init__(self, config):
+        self._config = config
+        self._username = os.getenv("ARISTA_USERNAME", config.get("username"))
+        self._password = os.getenv("ARISTA_PASSWORD", config.get("password"))
+
+    def resolve(
+        self, target, module_names=None, timeout=None, deadline=None, filters=None
+    ):
+        # filters are the filter settings of the request, they override
+        # the ones from the config
+        if timeout is None:
+            timeout = self._config["timeout"]
+        if deadline is None:
+            deadline = time.time() + timeout
+        return ScrapePlan(
+            target=target,
+            modules=parse_modules(module_names),
+            timeout=timeout,
+            deadline=deadline,
+            username=self._username,
+            password=self._password,
+            filter=make_filter(get_filter_settings(self._config, target, filters)),
+        )
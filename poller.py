@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client.core import GaugeMetricFamily
+
+import logging
+import random
+import threading
+import time
+
+from collector import AristaMetricsCollector
+from exposition import OPENMETRICS_EOF, RenderCache, render
+from plan import MODULE_DEPENDENCIES, PlanResolver, parse_modules
+
+# a module is reported as stale when it was not refreshed for this many
+# poll intervals
+STALE_INTERVALS = 2
+
+
+class Poller(object):
+    def __init__(self, config):
+        self._config = config
+        self._targets = config["poll_targets"]
+        self._interval = config.get("poll_interval", 30)
+        self._intervals = config.get("poll_intervals") or {}
+        self._jitter = config.get("poll_jitter", 0.1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.get("poll_workers", 16), thread_name_prefix="poll"
+        )
+        self._thread = threading.Thread(target=self._run, name="poller", daemon=True)
+        self._plans = PlanResolver(config)
+        self._running = set()
+        # target -> module -> next poll time
+        self._due = {}
+        # target -> module -> (RenderCache of the metrics, duration, poll time)
+        self._cache = {}
+        self._dependencies = MODULE_DEPENDENCIES
+        self._modules = list(parse_modules(config.get("poll_modules", "all")))
+        now = time.time()
+        for target in self._targets:
+            # spread the first poll of the targets over the whole interval
+            first_poll = now + random.uniform(0, self._interval)
+            self._due[target] = {
+                module: first_poll for module in ["base"] + self._modules
+            }
+            self._cache[target] = {}
+
+    def get_interval(self, module):
+        return self._intervals.get(module, self._interval)
+
+    def start(self):
+        logging.info(f"Polling {len(self._targets)} targets in the background")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._executor.shutdown(wait=False)
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.time()
+            with self._lock:
+                due = [
+                    target
+                    for target, modules in self._due.items()
+                    if target not in self._running and min(modules.values()) <= now
+                ]
+                self._running.update(due)
+            for target in due:
+                self._executor.submit(self.poll, target)
+            self._stop.wait(1)
+
+    def _get_due_modules(self, target, now):
+        due = [module for module in self._modules if self._due[target][module] <= now]
+        for module in list(due):
+            for dependency in self._dependencies.get(module, []):
+                if dependency in self._modules and dependency not in due:
+                    due.append(dependency)
+        return due
+
+    def _schedule(self, target, module, now):
+        interval = self.get_interval(module)
+        jitter = random.uniform(-self._jitter, self._jitter) * interval
+        self._due[target][module] = now + interval + jitter
+
+    def poll(self, target):
+        try:
+            now = time.time()
+            modules = self._get_due_modules(target, now)
+            collector = AristaMetricsCollector(
+                self._config, self._plans.resolve(target, ",".join(modules))
+            )
+            start = time.time()
+            base = RenderCache(list(collector.collect_base()))
+            results = {"base": (base, time.time() - start, now)}
+            if collector.is_up():
+                for name, metrics, duration in collector.collect_modules():
+                    results[name] = (RenderCache(metrics), duration, now)
+            # the text format is rendered ahead, the others on first request
+            for data, _, _ in results.values():
+                data.render()
+            with self._lock:
+                self._cache[target].update(results)
+                self._schedule(target, "base", now)
+                for module in modules:
+                    self._schedule(target, module, now)
+        except Exception as e:
+            logging.error(f"Polling of {target} failed: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(target)
+
+    def has_target(self, target):
+        return target in self._cache
+
+    def metrics(self, target, modules=None):
+        # Returns the cached metrics of the modules of the target, the ones
+        # of a module as one RenderCache, or None when the target was not
+        # polled yet. None returns all polled modules.
+        with self._lock:
+            cache = dict(self._cache.get(target, {}))
+        if "base" not in cache:
+            return None
+        if modules is None:
+            modules = self._modules
+        else:
+            modules = [m for m in self._modules if m in modules]
+
+        now = time.time()
+        scrape_durations = GaugeMetricFamily(
+            "arista_scrape_duration_seconds",
+            "Duration of a collector scrape.",
+            labels=["collector"],
+        )
+        poll_age = GaugeMetricFamily(
+            "arista_poll_age_seconds",
+            "Seconds since the data of a collector was polled from the switch",
+            labels=["collector"],
+        )
+        poll_stale = GaugeMetricFamily(
+            "arista_poll_stale",
+            "Value 1 if the data of a collector was not refreshed in time",
+            labels=["collector"],
+        )
+        metrics = []
+        for module in ["base"] + modules:
+            if module not in cache:
+                continue
+            data, duration, polled = cache[module]
+            metrics.append(data)
+            age = now - polled
+            stale = age > STALE_INTERVALS * self.get_interval(module)
+            scrape_durations.add_metric([module], duration)
+            poll_age.add_metric([module], age)
+            poll_stale.add_metric([module], 1 if stale else 0)
+        return metrics + [scrape_durations, poll_age, poll_stale]
+
+    def exposition(self, target, module_names=None, fmt="text"):
+        # Returns the cached metrics of the target in the format or None
+        # when the target was not polled yet
+        modules = None
+        if module_names and "all" not in module_names.split(","):
+            modules = module_names.split(",")
+        metrics = self.metrics(target, modules)
+        if metrics is None:
+            return None
+        output = render(metrics, fmt)
+        if fmt == "openmetrics":
+            output += OPENMETRICS_EOF
+        return output
@@ -7,6 +7,10 @@ setup(
     description='Arista EOS Exporter',
     author='Stefan Safar',
     author_email='stefan.safar@showmax.com',
-    scripts=['main.py', 'handler.py', 'collector.py'],
+    scripts=['main.py', 'handler.py', 'collector.py', 'connections.py', 'cache.py',
+             'exposition.py', 'poller.py', 'workers.py',
+             'instrumentation.py', 'async_eapi.py', 'interfaces.py', 'health.py',
+             'filters.py', 'plan.py', 'cluster.py'],
     py_modules=[],
+    python_requires='>=3.9',
 )
@@ -0,0 +1,104 @@
+import logging
+import os
+import signal
+import time
+
+
+class WorkerSupervisor(object):
+    # Pre-forks worker processes that accept connections on the same
+    # listening socket, so parsing and rendering use more than one core.
+    # SIGHUP reloads the config and replaces the workers gracefully,
+    # SIGTERM and SIGINT stop them.
+    def __init__(self, config, sock, run_worker, load_config):
+        self._config = config
+        self._sock = sock
+        self._run_worker = run_worker
+        self._load_config = load_config
+        self._processes = config["worker_processes"]
+        # pid -> generation of the config the worker was started with
+        self._workers = {}
+        self._generation = 0
+        self._reload = False
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        logging.info(f"Starting {self._processes} worker processes")
+        for _ in range(self._processes):
+            self._spawn()
+        while self._workers:
+            if self._reload:
+                self._reload = False
+                self.reload()
+            self._reap()
+            time.sleep(0.5)
+        self._sock.close()
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        if not self._stopping:
+            logging.info("Stopping the worker processes")
+            self._stopping = True
+            self._signal_workers(list(self._workers))
+
+    def _signal_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # the supervisor decides when the workers stop
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self._run_worker(self._config, self._sock)
+                code = 0
+            except Exception:
+                logging.exception("Worker process failed")
+            finally:
+                os._exit(code)
+        logging.debug(f"Started worker process {pid}")
+        self._workers[pid] = self._generation
+
+    def _reap(self):
+        while self._workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            generation = self._workers.pop(pid, None)
+            if generation == self._generation and not self._stopping:
+                logging.warning(
+                    f"Worker process {pid} exited unexpectedly "
+                    f"with status {status}, restarting it"
+                )
+                self._spawn()
+
+    def reload(self):
+        config = self._load_config()
+        if config is None:
+            logging.error("Reloading the config failed, keeping the old workers")
+            return
+        if (config["listen_addr"], config["listen_port"]) != (
+            self._config["listen_addr"],
+            self._config["listen_port"],
+        ):
+            logging.warning("A new listen address needs a restart of the exporter")
+        logging.info("Reloading the worker processes")
+        old = list(self._workers)
+        self._config = config
+        self._processes = config["worker_processes"]
+        self._generation += 1
+        # start the new workers before the old ones stop accepting
+        for _ in range(self._processes):
+            self._spawn()
+        self._signal_workers(old)